@@ -0,0 +1,425 @@
+import http.client
+import io
+import json
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import main
+
+class _ListSortedDict:
+
+    def __init__(self):
+        self._list = []
+
+    def key_at(self, index):
+        return self._list[index][0]
+
+    def value_at(self, index):
+        return self._list[index][1]
+
+    def _index_in_range(self, start, key, end):
+        if start == end:
+            return start
+        midpoint = start + ((end - start) // 2)
+        if self.key_at(midpoint) < key:
+            return self._index_in_range(midpoint + 1, key, end)
+        else:
+            return self._index_in_range(start, key, midpoint)
+
+    def _index(self, key):
+        return self._index_in_range(0, key, len(self._list))
+
+    def _has_key_at(self, key, index):
+        if index == len(self._list):
+            return False
+        else:
+            return self.key_at(index) == key
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        if self._has_key_at(key, index):
+            return self.value_at(index)
+        else:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        index = self._index(key)
+        if self._has_key_at(key, index):
+            self._list[index] = (key, value)
+        else:
+            self._list.insert(index, (key, value))
+
+    def __delitem__(self, key):
+        index = self._index(key)
+        if self._has_key_at(key, index):
+            del self._list[index]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._has_key_at(key, self._index(key))
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def _labels(size, seed=0):
+    rng = random.Random(seed)
+    return [f'SKU-{rng.randrange(10 ** 9):09}' for _ in range(size)]
+
+def _fill(dictionary, labels):
+    for label in labels:
+        dictionary[label] = 1
+
+def _probe(dictionary, labels):
+    for label in labels:
+        label in dictionary
+
+def _positions(dictionary, size):
+    for index in range(0, size, 7):
+        dictionary.key_at(index)
+
+def _empty(dictionary, labels):
+    for label in labels:
+        del dictionary[label]
+
+def _sorted_dict_rows(size):
+    labels = list(dict.fromkeys(_labels(size)))
+    for name, factory in [('list', _ListSortedDict), ('chunked', main._SortedDict)]:
+        dictionary = factory()
+        yield [name, size, 'insert', _timed(_fill, dictionary, labels)]
+        yield [name, size, 'contains', _timed(_probe, dictionary, labels)]
+        yield [name, size, 'key_at', _timed(_positions, dictionary, len(labels))]
+        yield [name, size, 'delete', _timed(_empty, dictionary, labels)]
+
+def _format_rows(rows):
+    for row in rows:
+        *cells, seconds = row
+        yield [*cells, f'{seconds * 1000:.1f}ms']
+
+def sorted_dict(sizes=(1000, 10000, 100000)):
+    data = [['Class', 'Labels', 'Operation', 'Time']]
+    for size in sizes:
+        data.extend(_format_rows(_sorted_dict_rows(size)))
+    print(main._table(data, 'lrlr', '0333'))
+
+class _DictUnits:
+
+    def __init__(self, units):
+        self._units = units
+
+def _instance_size(value):
+    size = sys.getsizeof(value)
+    if hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__)
+    return size
+
+def _trade(count, labels):
+    item_branch = main.branch('Initial')
+    for index in range(count):
+        label = labels[index % len(labels)]
+        item_branch.item(label).units(2).buy(1.25)
+        item_branch.item(label).sell(0.99)
+
+def values(count=100000):
+    main.reset()
+    main.branch('Initial').deposit(10 ** 7)
+    labels = _labels(1000)
+    seconds = _timed(_trade, count, labels)
+    tracemalloc.start()
+    _trade(count // 10, labels)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    data = [['Measure', 'Value'],
+            ['buy + sell', f'{seconds / count * 1e6:.2f}us'],
+            ['peak traced memory', f'{peak // 1024}KiB'],
+            ['units with __dict__', f'{_instance_size(_DictUnits(5))}B'],
+            ['units with __slots__', f'{_instance_size(main._Units(5))}B']]
+    print(main._table(data, 'lr', '03'))
+    main.reset()
+
+class _Workload:
+
+    def __init__(self, seed, branches, labels):
+        self._rng = random.Random(seed)
+        self._branches = branches
+        self._labels = _labels(labels, seed)
+        self._count = 0
+
+    def _branch(self):
+        return main.branch(self._rng.randrange(len(main._branches)) + 1)
+
+    def _label(self):
+        return self._rng.choice(self._labels)
+
+    def populate(self):
+        main.reset()
+        main.deposit(10 ** 8)
+        main.branch('Initial').split(self._branches)
+        for index in range(self._branches):
+            main.branch(f'Initial ({index + 1})').rename(f'Store {index + 1}')
+        for label in self._labels:
+            main.branch(f'Store {self._rng.randrange(self._branches) + 1}').item(label).units(
+                self._rng.randrange(1, 20)).buy(self._rng.randrange(100, 5000) / 100)
+
+    def _sell(self, branch):
+        inventory = branch._branch.inventory()
+        if len(inventory) == 0:
+            return self._buy(branch)
+        branch.item(self._rng.randrange(len(inventory)) + 1).sell(
+            self._rng.randrange(100, 9000) / 100)
+
+    def _buy(self, branch):
+        branch.item(self._label()).units(self._rng.randrange(1, 5)).buy(
+            self._rng.randrange(100, 5000) / 100)
+
+    def _relabel(self, branch):
+        inventory = branch._branch.inventory()
+        if len(inventory) == 0:
+            return self._buy(branch)
+        self._count += 1
+        branch.item(self._rng.randrange(len(inventory)) + 1).relabel(f'{self._label()}-{self._count}')
+
+    def _split_or_merge(self, branch):
+        if len(main._branches) > self._branches:
+            other = self._branch()
+            if other._branch is not branch._branch:
+                branch.merge(other)
+        else:
+            names = list(branch._branch._split_name(2))
+            if not any(name in main._branches for name in names):
+                branch.split(2)
+
+    def command(self):
+        branch = self._branch()
+        choice = self._rng.random()
+        if choice < 0.40:
+            self._buy(branch)
+        elif choice < 0.70:
+            self._sell(branch)
+        elif choice < 0.75:
+            self._relabel(branch)
+        elif choice < 0.85:
+            branch.clock(self._rng.randrange(1, 16) / 4)
+        elif choice < 0.92:
+            branch.deposit(self._rng.randrange(1, 1000))
+        elif choice < 0.995:
+            main.earn(self._rng.randrange(1, 1000))
+        else:
+            self._split_or_merge(branch)
+
+    def run(self, commands):
+        for _ in range(commands):
+            self.command()
+
+_tiers = {'small':  (10, 1000, 5000),
+          'medium': (50, 10000, 20000),
+          'large':  (200, 100000, 100000)}
+
+def _measure(function, calls, sample=None):
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    (sample or function)()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+def _operations(workload, directory):
+    file_name = os.path.join(directory, 'shop.save')
+    store = main.branch(1)
+    sink = io.StringIO()
+    def reset_sink():
+        sink.seek(0)
+        sink.truncate()
+    def inventory():
+        store.inventory(file=sink)
+        reset_sink()
+    def first_page():
+        store.inventory(page=1, file=sink)
+        reset_sink()
+    def branch_summaries():
+        main.branch_summaries(sort_by='wage', file=sink)
+        reset_sink()
+    yield 'command mix', 1000, workload.command
+    yield 'branch.deposit', 1000, lambda: store.deposit(1)
+    yield 'item.buy', 1000, lambda: store.item('bench').buy(1)
+    yield 'item.sell', 1000, lambda: store.item('bench').sell(1)
+    yield 'deposit', 100, lambda: main.deposit(1)
+    yield 'inventory', 10, inventory
+    yield 'inventory page', 100, first_page
+    yield 'branch_summaries', 10, branch_summaries
+    yield 'save', 3, lambda: main.save(file_name)
+    yield 'load', 3, lambda: main.load(file_name)
+    yield 'load lazy', 3, lambda: main.load(file_name, lazy=True)
+
+def _suite_rows(tier):
+    branches, labels, commands = _tiers[tier]
+    workload = _Workload(0, branches, labels)
+    seconds, peak = _measure(workload.populate, 1, _Workload(0, branches, labels).populate)
+    yield tier, 'populate', labels, seconds, peak
+    seconds, peak = _measure(lambda: workload.run(commands), 1,
+                             lambda: workload.run(commands // 10))
+    yield tier, 'workload', commands, seconds, peak
+    with tempfile.TemporaryDirectory() as directory:
+        for name, calls, function in _operations(workload, directory):
+            seconds, peak = _measure(function, calls)
+            yield tier, name, calls, seconds, peak
+    main.reset()
+
+def _suite_table(rows, previous):
+    data = [['Tier', 'Operation', 'Calls', 'Per Call', 'Per Second', 'Peak', 'Last Run']]
+    for tier, name, calls, seconds, peak in rows:
+        per_call = seconds / calls
+        last = previous.get(tier, {}).get(name)
+        change = '' if last is None else f'{per_call / last["per_call"]:.2f}x'
+        data.append([tier, name, calls,
+                     f'{per_call * 1e6:.1f}us',
+                     f'{calls / seconds:.0f}',
+                     f'{peak // 1024}KiB',
+                     change])
+    return data
+
+def suite(tiers=('small', 'medium'), results_file='benchmark_results.json'):
+    previous = {}
+    if os.path.exists(results_file):
+        with open(results_file) as file:
+            previous = json.load(file)
+    rows = []
+    for tier in tiers:
+        rows.extend(_suite_rows(tier))
+    print(main._table(_suite_table(rows, previous), 'llrrrrr', '0333333'))
+    results = {}
+    for tier, name, calls, seconds, peak in rows:
+        results.setdefault(tier, {})[name] = {'calls': calls,
+                                              'per_call': seconds / calls,
+                                              'peak': peak}
+    with open(results_file, 'w') as file:
+        json.dump({**previous, **results}, file, indent=1)
+
+def _save_pickle(file_name):
+    with open(file_name, 'wb') as file:
+        pickle.dump(main._get_state(), file, pickle.HIGHEST_PROTOCOL)
+
+def _formats():
+    yield 'pickle', _save_pickle
+    yield 'binary', main.save
+    yield 'binary zlib', lambda file_name: main.save(file_name, compress=True)
+
+def _snapshot_rows(tier, directory):
+    branches, labels, commands = _tiers[tier]
+    workload = _Workload(0, branches, labels)
+    workload.populate()
+    workload.run(commands)
+    for name, save in _formats():
+        file_name = os.path.join(directory, f'{tier} {name}')
+        main._load_inventories()
+        saved = _timed(save, file_name)
+        loaded = _timed(main.load, file_name)
+        lazy = _timed(lambda: main.load(file_name, lazy=True))
+        yield [tier, name, saved, loaded, lazy, os.path.getsize(file_name)]
+    main.reset()
+
+def snapshot(tiers=('small', 'medium')):
+    data = [['Tier', 'Format', 'Save', 'Load', 'Load Lazy', 'Size']]
+    with tempfile.TemporaryDirectory() as directory:
+        for tier in tiers:
+            for tier, name, *seconds, size in _snapshot_rows(tier, directory):
+                data.append([tier, name, *(f'{each * 1000:.1f}ms' for each in seconds),
+                             f'{size // 1024}KiB'])
+    print(main._table(data, 'llrrrr', '033333'))
+
+_serving_paths = ['/summary',
+                  '/branch_summaries?sort_by=wage',
+                  '/branch_summaries?page=1',
+                  '/branch/summary?num=1',
+                  '/branch/inventory?num=1&page=1',
+                  '/branch/inventory?num=2']
+
+def _fetch(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        connection.close()
+
+def _client(port, seed, stop, results):
+    rng = random.Random(seed)
+    while not stop.is_set():
+        path = rng.choice(_serving_paths)
+        start = time.perf_counter()
+        status = _fetch(port, path)
+        results.append((path, status, time.perf_counter() - start))
+
+def _latency_rows(results):
+    by_path = {}
+    for path, status, seconds in results:
+        by_path.setdefault(path, []).append((status, seconds))
+    for path in _serving_paths:
+        responses = by_path.get(path, [])
+        times = sorted(seconds for _, seconds in responses)
+        failed = sum(status != 200 for status, _ in responses)
+        if times:
+            yield [path, len(times), failed,
+                   f'{times[len(times) // 2] * 1000:.2f}ms',
+                   f'{times[min(len(times) - 1, len(times) * 99 // 100)] * 1000:.2f}ms']
+
+def serving(tier='small', clients=8):
+    branches, labels, commands = _tiers[tier]
+    workload = _Workload(0, branches, labels)
+    workload.populate()
+    alone = _timed(workload.run, commands)
+    main.serve(port=0)
+    port = main._server[1].sockets[0].getsockname()[1]
+    stop = threading.Event()
+    results = []
+    threads = [threading.Thread(target=_client, args=(port, seed, stop, results))
+               for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    try:
+        served = _timed(workload.run, commands)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        main.stop_serving()
+        main.reset()
+    data = [['Path', 'Requests', 'Failed', 'p50', 'p99']]
+    data.extend(_latency_rows(results))
+    print(main._table(data, 'lrrrr', '03333'))
+    failed = sum(status != 200 for _, status, _ in results)
+    data = [['Measure', 'Value'],
+            ['commands alone', f'{commands / alone:.0f}/s'],
+            [f'commands with {clients} clients', f'{commands / served:.0f}/s'],
+            ['requests', f'{len(results) / served:.0f}/s'],
+            ['failed requests', failed]]
+    print(main._table(data, 'lr', '03'))
+    if failed:
+        raise AssertionError(f'{failed} requests failed')
+
+_benchmarks = {'sorted_dict': sorted_dict,
+               'values': values,
+               'suite': suite,
+               'snapshot': snapshot,
+               'serving': serving}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or _benchmarks:
+        print(name)
+        _benchmarks[name]()
+        print()
@@ -1,67 +1,255 @@
 
+import asyncio
+import atexit
+import csv
+import functools
+import io
+import json
+import mmap
+import os
+import pickle
+import random
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from datetime import date, timedelta
+from decimal import Decimal
+from heapq import merge as merge_sorted, nlargest
+from itertools import accumulate, chain, count, islice, zip_longest
+from operator import itemgetter
+from urllib.parse import parse_qs, unquote, urlsplit
+
 class _SortedDict:
 
+    _load = 256
+    _owned = None
+
     def __init__(self):
-        self._list = []
+        self._keys = []
+        self._values = []
+        self._maxes = []
+        self._len = 0
+        self._offsets = None
+
+    def __len__(self):
+        return self._len
+
+    def __setstate__(self, state):
+        if '_list' in state:
+            self.__init__()
+            self._extend_sorted(state['_list'])
+        else:
+            self.__dict__.update(state)
+
+    def _own(self, chunk):
+        if self._owned is not None and not self._owned[chunk]:
+            self._keys[chunk] = list(self._keys[chunk])
+            self._values[chunk] = list(self._values[chunk])
+            self._owned[chunk] = True
+
+    def freeze(self):
+        frozen = _SortedDict()
+        frozen._keys = list(self._keys)
+        frozen._values = list(self._values)
+        frozen._maxes = list(self._maxes)
+        frozen._len = self._len
+        self._owned = [False] * len(self._keys)
+        return frozen
+
+    def copy(self):
+        copy = self.freeze()
+        copy._owned = [False] * len(copy._keys)
+        return copy
+
+    def _extend_sorted(self, items):
+        for key, value in items:
+            if self._keys and len(self._keys[-1]) < self._load:
+                self._own(len(self._keys) - 1)
+                self._keys[-1].append(key)
+                self._values[-1].append(value)
+                self._maxes[-1] = key
+            else:
+                self._keys.append([key])
+                self._values.append([value])
+                self._maxes.append(key)
+                if self._owned is not None:
+                    self._owned.append(True)
+            self._len += 1
+        self._offsets = None
 
     def items(self):
-        yield from self._list
+        for keys, values in zip(self._keys, self._values):
+            yield from zip(keys, values)
 
     def keys(self):
-        for key, _ in self._list:
-            yield key
+        for keys in self._keys:
+            yield from keys
+
+    def _chunk_offsets(self):
+        if self._offsets is None:
+            self._offsets = []
+            offset = 0
+            for keys in self._keys:
+                self._offsets.append(offset)
+                offset += len(keys)
+        return self._offsets
+
+    def _position(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError(index)
+        offsets = self._chunk_offsets()
+        chunk = bisect_left(offsets, index + 1) - 1
+        return chunk, index - offsets[chunk]
+
+    def bisect(self, key):
+        chunk, position, _ = self._locate(key)
+        if chunk == len(self._keys):
+            return self._len
+        return self._chunk_offsets()[chunk] + position
 
     def key_at(self, index):
-        return self._list[index][0]
+        chunk, position = self._position(index)
+        return self._keys[chunk][position]
 
     def values(self):
-        for _, value in self._list:
-            yield value
+        for values in self._values:
+            yield from values
 
     def value_at(self, index):
-        return self._list[index][1]
-
-    def _index_in_range(self, start, key, end):
-        if start == end:
-            return start
-        midpoint = start + ((end - start) // 2)
-        if self.key_at(midpoint) < key:
-            return self._index_in_range(midpoint + 1, key, end)
-        else:
-            return self._index_in_range(start, key, midpoint)
-    
-    def _index(self, key):
-        return self._index_in_range(0, key, len(self._list))
-
-    def _has_key_at(self, key, index):
-        if index == len(self._list):
-            return False
-        else:
-            return self.key_at(index) == key
+        chunk, position = self._position(index)
+        return self._values[chunk][position]
+
+    def _locate(self, key):
+        chunk = bisect_left(self._maxes, key)
+        if chunk == len(self._maxes):
+            return chunk, 0, False
+        position = bisect_left(self._keys[chunk], key)
+        return chunk, position, self._keys[chunk][position] == key
+
+    def _split_chunk(self, chunk):
+        keys = self._keys[chunk]
+        values = self._values[chunk]
+        half = len(keys) // 2
+        self._keys[chunk:chunk + 1] = [keys[:half], keys[half:]]
+        self._values[chunk:chunk + 1] = [values[:half], values[half:]]
+        self._maxes[chunk:chunk + 1] = [keys[half - 1], keys[-1]]
+        if self._owned is not None:
+            self._owned[chunk:chunk + 1] = [True, True]
+
+    def _join_chunk(self, chunk):
+        if chunk + 1 == len(self._keys):
+            chunk -= 1
+        if chunk < 0:
+            return
+        self._own(chunk)
+        if self._owned is not None:
+            del self._owned[chunk + 1]
+        self._keys[chunk] += self._keys.pop(chunk + 1)
+        self._values[chunk] += self._values.pop(chunk + 1)
+        del self._maxes[chunk]
+        if len(self._keys[chunk]) > 2 * self._load:
+            self._split_chunk(chunk)
 
     def __getitem__(self, key):
-        index = self._index(key)
-        if self._has_key_at(key, index):
-            return self.value_at(index)
+        chunk, position, found = self._locate(key)
+        if found:
+            return self._values[chunk][position]
         else:
             raise KeyError(key)
 
     def __setitem__(self, key, value):
-        index = self._index(key)
-        if self._has_key_at(key, index):
-            self._list[index] = (key, value)
-        else:
-            self._list.insert(index, (key, value))
+        chunk, position, found = self._locate(key)
+        if found:
+            self._own(chunk)
+            self._values[chunk][position] = value
+            return
+        if chunk == len(self._maxes):
+            if not self._keys:
+                self._extend_sorted([(key, value)])
+                return
+            chunk -= 1
+            position = len(self._keys[chunk])
+            self._maxes[chunk] = key
+        self._own(chunk)
+        self._keys[chunk].insert(position, key)
+        self._values[chunk].insert(position, value)
+        self._len += 1
+        self._offsets = None
+        if len(self._keys[chunk]) > 2 * self._load:
+            self._split_chunk(chunk)
 
     def __delitem__(self, key):
-        index = self._index(key)
-        if self._has_key_at(key, index):
-            del self._list[index]
-        else:
+        chunk, position, found = self._locate(key)
+        if not found:
             raise KeyError(key)
+        self._own(chunk)
+        keys = self._keys[chunk]
+        del keys[position]
+        del self._values[chunk][position]
+        self._len -= 1
+        self._offsets = None
+        if not keys:
+            del self._keys[chunk]
+            del self._values[chunk]
+            del self._maxes[chunk]
+            if self._owned is not None:
+                del self._owned[chunk]
+            return
+        self._maxes[chunk] = keys[-1]
+        if len(keys) < self._load // 4:
+            self._join_chunk(chunk)
 
     def __contains__(self, key):
-        return self._has_key_at(key, self._index(key))
+        return self._locate(key)[2]
+
+    def get(self, key, default=None):
+        chunk, position, found = self._locate(key)
+        if found:
+            return self._values[chunk][position]
+        else:
+            return default
+
+    def items_at(self, start, stop):
+        if start >= min(stop, self._len):
+            return
+        chunk, position = self._position(start)
+        remaining = stop - start
+        for keys, values in zip(self._keys[chunk:], self._values[chunk:]):
+            items = list(zip(keys[position:position + remaining], values[position:]))
+            yield from items
+            remaining -= len(items)
+            if remaining <= 0:
+                return
+            position = 0
+
+    def from_sorted(items):
+        dictionary = _SortedDict()
+        dictionary._extend_sorted(items)
+        return dictionary
+
+    def from_sorted_lists(keys, values):
+        dictionary = _SortedDict()
+        load = dictionary._load
+        dictionary._keys = [keys[start:start + load] for start in range(0, len(keys), load)]
+        dictionary._values = [values[start:start + load] for start in range(0, len(values), load)]
+        dictionary._maxes = [chunk[-1] for chunk in dictionary._keys]
+        dictionary._len = len(keys)
+        return dictionary
+
+    def items_from(self, key):
+        chunk, position, _ = self._locate(key)
+        for keys, values in zip(self._keys[chunk:], self._values[chunk:]):
+            yield from zip(keys[position:], values[position:])
+            position = 0
 
 def _check_type(obj, typ):
     if type(obj) is not typ:
@@ -72,8 +260,8 @@ def _check_minimum(num, minimum):
         raise ValueError(num)
 
 def _strictly_round(unrounded):
-    rounded = int(unrounded)
-    if rounded != unrounded:
+    rounded = round(unrounded)
+    if abs(rounded - unrounded) > 1e-6:
         raise ValueError(unrounded)
     return rounded
 
@@ -88,8 +276,16 @@ def _split_int(num, ways):
 class _ErrInsufficient(ValueError):
     pass
 
+class _ErrInconsistent(RuntimeError):
+    pass
+
+class _ErrNotUndoable(ValueError):
+    pass
+
 class _RowNum:
 
+    __slots__ = ('_num',)
+
     def __init__(self, num):
         _check_type(num, int)
         _check_minimum(num, 1)
@@ -104,7 +300,20 @@ class _RowNum:
     def from_index(index):
         return _RowNum(index + 1)
 
-class _Units:
+class _Value:
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return type(self), (int(self),)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+class _Units(_Value):
+
+    __slots__ = ('_units',)
 
     def __init__(self, units):
         _check_type(units, int)
@@ -112,14 +321,12 @@ class _Units:
         self._units = units
 
     def __add__(self, other):
-        check_type(other, _Units)
-        return _Units(self._units + other._units)
+        return _Units._raw(self._units + other._units)
 
     def __sub__(self, other):
-        _check_type(other, _Units)
         if self._units < other._units:
             raise _ErrInsufficient(self)
-        return _Units(self._units - other._units)
+        return _Units._raw(self._units - other._units)
 
     def __int__(self):
         return self._units
@@ -127,7 +334,18 @@ class _Units:
     def __str__(self):
         return f'{self._units}x'
 
-class _Cents:
+    def _raw(units):
+        if units < len(_small_units):
+            return _small_units[units]
+        value = object.__new__(_Units)
+        value._units = units
+        return value
+
+_small_units = [_Units(units) for units in range(1024)]
+
+class _Cents(_Value):
+
+    __slots__ = ('_cents',)
 
     def __init__(self, cents):
         _check_type(cents, int)
@@ -138,12 +356,10 @@ class _Cents:
             raise ValueError(self)
 
     def __add__(self, other):
-        _check_type(other, _Cents)
-        return _Cents(self._cents + other._cents)
+        return _Cents._raw(self._cents + other._cents)
 
     def __sub__(self, other):
-        _check_type(other, _Cents)
-        return _Cents(self._cents - other._cents)
+        return _Cents._raw(self._cents - other._cents)
 
     def __int__(self):
         return self._cents
@@ -157,12 +373,19 @@ class _Cents:
 
     def split(self, ways):
         for part in _split_int(self._cents, ways):
-            yield _Cents(part)
+            yield _Cents._raw(part)
 
     def from_dollars(dollars):
-        return _Cents(_strictly_round(dollars * 100))
+        return _Cents._raw(_strictly_round(dollars * 100))
 
-class _Balance:
+    def _raw(cents):
+        value = object.__new__(_Cents)
+        value._cents = cents
+        return value
+
+class _Balance(_Value):
+
+    __slots__ = ('_cents',)
 
     def __init__(self, cents):
         _check_type(cents, int)
@@ -170,22 +393,20 @@ class _Balance:
         self._cents = cents
 
     def check(self, cents):
-        _check_type(cents, _Cents)
         cents.check_positive()
         if self._cents < cents._cents:
             raise _ErrInsufficient(self)
 
     def as_cents(self):
-        return _Cents(self._cents)
+        return _Cents._raw(self._cents)
 
     def __add__(self, cents):
-        _check_type(cents, _Cents)
         cents.check_positive()
-        return _Balance(self._cents + int(cents))
+        return _Balance._raw(self._cents + cents._cents)
 
     def __sub__(self, cents):
         self.check(cents)
-        return _Balance(self._cents - int(cents))
+        return _Balance._raw(self._cents - cents._cents)
 
     def __int__(self):
         return self._cents
@@ -196,9 +417,16 @@ class _Balance:
 
     def split(self, ways):
         for part in _split_int(self._cents, ways):
-            yield _Balance(part)
+            yield _Balance._raw(part)
+
+    def _raw(cents):
+        value = object.__new__(_Balance)
+        value._cents = cents
+        return value
+
+class _Minutes(_Value):
 
-class _Minutes:
+    __slots__ = ('_minutes',)
 
     def __init__(self, minutes):
         _check_type(minutes, int)
@@ -206,8 +434,7 @@ class _Minutes:
         self._minutes = minutes
 
     def __add__(self, other):
-        check_type(other, _Minutes)
-        return _Minutes(self._minutes + other._minutes)
+        return _Minutes._raw(self._minutes + other._minutes)
 
     def __int__(self):
         return self._minutes
@@ -219,16 +446,23 @@ class _Minutes:
 
     def split(self, ways):
         for part in _split_int(self._minutes, ways):
-            yield _Minutes(part)
+            yield _Minutes._raw(part)
 
     def as_hours(self):
         return self._minutes / 60
 
     def from_hours(hours):
-        return _Minutes(strictly_round(hours * 60))
+        return _Minutes(_strictly_round(hours * 60))
+
+    def _raw(minutes):
+        value = object.__new__(_Minutes)
+        value._minutes = minutes
+        return value
 
 class _Wage:
 
+    __slots__ = ('_hourly',)
+
     def __init__(self, cents, minutes):
         _check_type(cents, _Cents)
         _check_type(minutes, _Minutes)
@@ -237,7 +471,7 @@ class _Wage:
         if hours == 0:
             self._hourly = None
         else:
-            self._hourly = _Cents(int(cents / hours))
+            self._hourly = _Cents._raw(int(cents / hours))
 
     def __str__(self):
         if self._hourly is None:
@@ -245,71 +479,625 @@ class _Wage:
         else:
             return f'{self._hourly}/h'
 
+_versions = count(1)
+
+def _lots_cost(lots):
+    if lots is None:
+        return 0
+    else:
+        return sum(cost for _, cost in lots)
+
+class _Taken(list):
+    # Lots taken off a queue. split is set when take() cut the last of them
+    # off the front lot, so putting them back in front joins the two halves.
+    split = False
+
+class _Lots:
+
+    __slots__ = ('_queue', '_cost')
+
+    def __init__(self, lots=()):
+        self._queue = deque()
+        self._cost = 0
+        self.extend(lots)
+
+    def __bool__(self):
+        return bool(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def cost(self):
+        return self._cost
+
+    def copy(self):
+        lots = _Lots()
+        lots._queue = self._queue.copy()
+        lots._cost = self._cost
+        return lots
+
+    def from_pairs(pairs, cost):
+        lots = _Lots.__new__(_Lots)
+        lots._queue = deque(pairs)
+        lots._cost = cost
+        return lots
+
+    def extend(self, lots):
+        for units, cost in lots:
+            if units != 0:
+                self._queue.append((units, cost))
+                self._cost += cost
+
+    def extend_front(self, lots):
+        if getattr(lots, 'split', False) and self._queue:
+            units, cost = self._queue.popleft()
+            self._cost -= cost
+            *lots, (last_units, last_cost) = lots
+            lots.append((last_units + units, last_cost + cost))
+        for units, cost in reversed(lots):
+            if units != 0:
+                self._queue.appendleft((units, cost))
+                self._cost += cost
+
+    def take(self, units, from_end=False):
+        queue = self._queue
+        taken = _Taken()
+        while units > 0:
+            lot_units, lot_cost = queue.pop() if from_end else queue.popleft()
+            if lot_units > units:
+                part = lot_cost * units // lot_units
+                rest = (lot_units - units, lot_cost - part)
+                if from_end:
+                    queue.append(rest)
+                else:
+                    queue.appendleft(rest)
+                    taken.split = True
+                lot_units, lot_cost = units, part
+            taken.append((lot_units, lot_cost))
+            self._cost -= lot_cost
+            units -= lot_units
+        if from_end:
+            taken.reverse()
+        return taken
+
 class _Inventory:
 
+    _owner = None
+    _ranks = None
+    _owned_lots = None
+    _frozen = None
+
     def __init__(self):
         self._dict = _SortedDict()
+        self._lots = {}
+        self._realized = {}
+        self._version = next(_versions)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_frozen', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+    def _own_lots(self, label):
+        queue = self._lots.get(label)
+        if queue is not None and self._owned_lots is not None and label not in self._owned_lots:
+            queue = queue.copy()
+            self._lots[label] = queue
+            self._owned_lots.add(label)
+        return queue
+
+    def frozen(self):
+        if self._frozen is None or self._frozen[0] != self._version:
+            self._owned_lots = set()
+            self._frozen = (self._version,
+                            (self._dict.freeze(), dict(self._lots), dict(self._realized)))
+        return self._frozen[1]
+
+    def _from_frozen(frozen):
+        items, lots, realized = frozen
+        inventory = _Inventory()
+        inventory._dict = items.copy()
+        inventory._lots = dict(lots)
+        inventory._realized = dict(realized)
+        inventory._owned_lots = set()
+        return inventory
+
+    def _index(self, label, units):
+        if self._owner is not None:
+            self._owner.labels().add(label, self._owner, units)
+
+    def _attach(self, owner, index=True):
+        self._owner = owner
+        if index:
+            for label, units in self._dict.items():
+                self._index(label, int(units))
+
+    def _detach(self):
+        for label, units in self._dict.items():
+            self._index(label, -int(units))
+        self._owner = None
+
+    def __len__(self):
+        return len(self._dict)
 
     def items(self):
         yield from self._dict.items()
 
+    def items_at(self, start, stop):
+        yield from self._dict.items_at(start, stop)
+
     def label_at(self, index):
         return self._dict.key_at(index)
 
+    def index_range(self, first, last=None):
+        start = self._dict.bisect(first)
+        if last is None:
+            return start, len(self._dict)
+        return start, max(start, self._dict.bisect(last))
+
+    def prefix_range(self, prefix):
+        return self.index_range(prefix, _prefix_end(prefix))
+
+    def _score(self, by, label):
+        if by == 'units':
+            return self.held(label)
+        lots = self._lots.get(label)
+        if lots is None:
+            return 0
+        else:
+            return lots.cost()
+
+    def _rank(self, label):
+        if self._ranks is not None and label in self._dict:
+            for by, ranks in self._ranks.items():
+                ranks[(-self._score(by, label), label)] = None
+
+    def _unrank(self, label):
+        if self._ranks is not None and label in self._dict:
+            for by, ranks in self._ranks.items():
+                del ranks[(-self._score(by, label), label)]
+
+    def ranked(self, by):
+        if by not in ('units', 'value'):
+            raise ValueError(by)
+        if self._ranks is None:
+            self._ranks = {}
+        ranks = self._ranks.get(by)
+        if ranks is None:
+            keys = sorted((-self._score(by, label), label) for label in self._dict.keys())
+            ranks = _SortedDict.from_sorted((key, None) for key in keys)
+            self._ranks[by] = ranks
+        return ranks.keys()
+
+    def held(self, label):
+        held = self._dict.get(label)
+        if held is None:
+            return 0
+        else:
+            return held._units
+
+    def cost(self, label):
+        lots = self._lots.get(label)
+        if lots is None:
+            return _Cents._raw(0)
+        else:
+            return _Cents._raw(lots.cost())
+
+    def realized(self, label):
+        return _Cents._raw(self._realized.get(label, 0))
+
     def acquire(self, label, units):
         _check_type(label, str)
         _check_type(units, _Units)
-        if int(units) == 0:
+        self._acquire(label, int(units))
+
+    def buy(self, label, units, cents):
+        _check_type(label, str)
+        _check_type(units, _Units)
+        _check_type(cents, _Cents)
+        self._acquire(label, int(units), int(cents))
+
+    def _add(self, label, units, lots=None, front=False):
+        if units == 0:
             return
-        elif label in self._dict:
-            self._dict[label] += units
+        self._unrank(label)
+        if lots is not None or label in self._lots:
+            queue = self._own_lots(label)
+            if queue is None:
+                queue = _Lots([(self.held(label), 0)])
+                self._lots[label] = queue
+            if lots is None:
+                lots = [(units, 0)]
+            if front:
+                queue.extend_front(lots)
+            else:
+                queue.extend(lots)
+        held = self._dict.get(label)
+        if held is None:
+            self._dict[label] = _Units._raw(units)
         else:
-            self._dict[label] = units
+            self._dict[label] = _Units._raw(held._units + units)
+        self._version = next(_versions)
+        self._index(label, units)
+        self._rank(label)
+
+    def _acquire(self, label, units, cost=0):
+        self._add(label, units, [(units, cost)] if cost != 0 else None)
 
     def discard(self, label, units):
         _check_type(label, str)
         _check_type(units, _Units)
-        if int(units) == 0:
-            return
-        elif label not in self._dict:
-            raise _ErrInsufficient(_Units(0))
-        elif int(self._dict[label]) == int(units):
+        return self._discard(label, int(units))
+
+    def sell(self, label, units, cents):
+        _check_type(label, str)
+        _check_type(units, _Units)
+        _check_type(cents, _Cents)
+        return self._sell(label, int(units), int(cents))
+
+    def _remove(self, label, units, from_end=False):
+        if units == 0:
+            return None
+        held = self._dict.get(label)
+        if held is None:
+            raise _ErrInsufficient(_Units._raw(0))
+        elif held._units < units:
+            raise _ErrInsufficient(held)
+        self._unrank(label)
+        if held._units == units:
             del self._dict[label]
         else:
-            self._dict[label] -= units
+            self._dict[label] = _Units._raw(held._units - units)
+        self._version = next(_versions)
+        self._index(label, -units)
+        queue = self._own_lots(label)
+        taken = None
+        if queue is not None:
+            taken = queue.take(units, from_end)
+            if not queue:
+                del self._lots[label]
+        self._rank(label)
+        return taken
+
+    def _realize(self, label, cents):
+        if cents == 0:
+            return
+        cents += self._realized.get(label, 0)
+        if cents != 0:
+            self._realized[label] = cents
+        else:
+            del self._realized[label]
+        self._version = next(_versions)
+
+    def _discard(self, label, units):
+        taken = self._remove(label, units)
+        self._realize(label, -_lots_cost(taken))
+        return taken
+
+    def _sell(self, label, units, cents):
+        taken = self._discard(label, units)
+        self._realize(label, cents)
+        return taken
+
+    def _restore(self, label, units, taken, cents=0):
+        self._add(label, units, taken, front=True)
+        self._realize(label, _lots_cost(taken) - cents)
 
     def relabel(self, old_label, new_label, units):
+        _check_type(old_label, str)
         _check_type(new_label, str)
-        self.discard(old_label, units)
-        self.acquire(new_label, units)
+        _check_type(units, _Units)
+        self._relabel(old_label, new_label, int(units))
+
+    def _relabel(self, old_label, new_label, units):
+        self._add(new_label, units, self._remove(old_label, units))
+
+    def _unrelabel(self, old_label, new_label, units):
+        self._add(old_label, units, self._remove(new_label, units, from_end=True), front=True)
+
+    def _from_sorted(items):
+        inventory = _Inventory()
+        inventory._dict = _SortedDict.from_sorted(items)
+        return inventory
 
     def split(self, ways):
-        inventories = [_Inventory() for _ in range(ways)]
-        index = 0
+        parts = [[] for _ in range(ways)]
+        lots = [{} for _ in range(ways)]
+        start = 0
         for label, units in self._dict.items():
-            for part in _split_int(int(units), ways):
-                index %= ways
-                inventories[index].aquire(label, _Units(part))
-                index += 1
-            index += int(units)
-        return inventories
+            units = int(units)
+            queue = self._lots.get(label)
+            amounts = [0] * ways
+            for offset, part in enumerate(_split_int(units, ways)):
+                if part == 0:
+                    break
+                parts[(start + offset) % ways].append((label, _Units._raw(part)))
+                amounts[(start + offset) % ways] = part
+            if queue is not None:
+                queue = _Lots(queue)
+                for child_lots, part in zip(lots, amounts):
+                    if part != 0:
+                        child_lots[label] = _Lots(queue.take(part))
+            start = (start + units) % ways
+        children = [_Inventory._from_sorted(items) for items in parts]
+        for child, child_lots in zip(children, lots):
+            child._lots = child_lots
+        for label, cents in self._realized.items():
+            for child, part in zip(children, _split_int(cents, ways)):
+                child._realize(label, part)
+        return children
 
     def merge(self, other):
         _check_type(other, _Inventory)
-        for label, units in other._dict.items():
-            self.acquire(label, units)
+        self.merge_many([other])
+
+    def merge_many(self, others):
+        runs = [self._dict.items()]
+        labels = set(self._lots)
+        for other in others:
+            _check_type(other, _Inventory)
+            runs.append(other._dict.items())
+            labels.update(other._lots)
+            for label, units in other._dict.items():
+                self._index(label, int(units))
+        lots = {}
+        for label in labels:
+            queue = _Lots()
+            for inventory in [self, *others]:
+                part = inventory._lots.get(label)
+                queue.extend(part if part is not None else [(inventory.held(label), 0)])
+            lots[label] = queue
+        merged = []
+        for label, units in merge_sorted(*runs, key=itemgetter(0)):
+            if merged and merged[-1][0] == label:
+                merged[-1] = (label, merged[-1][1] + units)
+            else:
+                merged.append((label, units))
+        self._dict = _SortedDict.from_sorted(merged)
+        self._version = next(_versions)
+        self._ranks = None
+        self._lots.update(lots)
+        for other in others:
+            for label, cents in other._realized.items():
+                self._realize(label, cents)
+
+    def _unmerge(self, other):
+        for label, units in other.items():
+            self._remove(label, int(units), from_end=True)
+        for label, cents in other._realized.items():
+            self._realize(label, -cents)
+
+class _Totals:
+
+    def __init__(self):
+        self._balance = 0
+        self._profit = 0
+        self._minutes = 0
+
+    def __eq__(self, other):
+        _check_type(other, _Totals)
+        return ((self._balance, self._profit, self._minutes)
+                == (other._balance, other._profit, other._minutes))
+
+    def add(self, cents_deposited, cents_earned, minutes_spent):
+        self._balance += cents_deposited
+        self._profit += cents_earned
+        self._minutes += minutes_spent
+
+    def balance(self):
+        return _Balance(self._balance)
+
+    def profit(self):
+        return _Cents(self._profit)
+
+    def time_spent(self):
+        return _Minutes(self._minutes)
+
+class _LabelIndex:
+
+    def __init__(self):
+        self._holders = _SortedDict()
+
+    def add(self, label, branch, units):
+        holders = self._holders.get(label)
+        if holders is None:
+            holders = {}
+            self._holders[label] = holders
+        units += holders.get(branch, 0)
+        if units != 0:
+            holders[branch] = units
+        else:
+            del holders[branch]
+            if not holders:
+                del self._holders[label]
+
+    def add_branches(self, branches):
+        # Indexes the loaded inventories of a whole shop at once. Only used
+        # on an empty index, where building it in one pass beats add().
+        holders = {}
+        for branch in branches:
+            if branch._inventory is not None:
+                for label, units in branch._inventory.items():
+                    holders.setdefault(label, {})[branch] = int(units)
+        labels = sorted(holders)
+        self._holders = _SortedDict.from_sorted_lists(labels, [holders[label] for label in labels])
+
+    def holders(self, label):
+        return self._holders.get(label, {})
+
+    def between(self, first, last):
+        for label, holders in self._holders.items_from(first):
+            if label >= last:
+                return
+            yield label, holders
+
+    def prefixed(self, prefix):
+        for label, holders in self._holders.items_from(prefix):
+            if not label.startswith(prefix):
+                return
+            yield label, holders
+
+    def count(self, first, last=None):
+        start = self._holders.bisect(first)
+        stop = len(self._holders) if last is None else max(start, self._holders.bisect(last))
+        units = sum(sum(holders.values()) for _, holders in self._holders.items_at(start, stop))
+        return stop - start, units
+
+def _prefix_end(prefix):
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+class _Ledger:
+
+    def __init__(self):
+        self._balances = array('q')
+        self._profits = array('q')
+        self._minutes = array('q')
+        self._free = []
+        self._totals = _Totals()
+        self._labels = _LabelIndex()
+        self._version = next(_versions)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_labels']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._labels = _LabelIndex()
+        self._version = next(_versions)
+
+    def touch(self):
+        self._version = next(_versions)
+
+    def totals(self):
+        return self._totals
+
+    def labels(self):
+        return self._labels
+
+    def allocate(self):
+        self.touch()
+        if self._free:
+            return self._free.pop()
+        self._balances.append(0)
+        self._profits.append(0)
+        self._minutes.append(0)
+        return len(self._balances) - 1
+
+    def release(self, slot):
+        self.touch()
+        self._totals.add(-self._balances[slot], -self._profits[slot], -self._minutes[slot])
+        self._balances[slot] = 0
+        self._profits[slot] = 0
+        self._minutes[slot] = 0
+        self._free.append(slot)
+
+    def balance(self, slot):
+        return self._balances[slot]
+
+    def profit(self, slot):
+        return self._profits[slot]
+
+    def minutes(self, slot):
+        return self._minutes[slot]
+
+    def values(self, slot):
+        return self._balances[slot], self._profits[slot], self._minutes[slot]
+
+    def balances(self, slots):
+        balances = self._balances
+        return [balances[slot] for slot in slots]
+
+    def profits(self, slots):
+        profits = self._profits
+        return [profits[slot] for slot in slots]
+
+    def times_spent(self, slots):
+        minutes = self._minutes
+        return [minutes[slot] for slot in slots]
+
+    def add(self, slot, cents_deposited, cents_earned, minutes_spent):
+        balance = self._balances[slot] + cents_deposited
+        if balance < 0:
+            raise _ErrInsufficient(_Balance._raw(self._balances[slot]))
+        self._balances[slot] = balance
+        self._profits[slot] += cents_earned
+        self._minutes[slot] += minutes_spent
+        self._totals.add(cents_deposited, cents_earned, minutes_spent)
+        self.touch()
+
+def _split_names(name, ways):
+    for i in range(ways):
+        yield f'{name} ({i+1})'
 
 class _Branch:
 
-    def __init__(self, name, description):
+    _source = None
+    _stored = None
+
+    def __init__(self, name, description, ledger=None):
         _check_type(name, str)
         _check_type(description, str)
+        if ledger is None:
+            ledger = _ledger
         self._name = name
         self._description = description
-        self._balance = _Balance(0)
-        self._profit = _Cents(0)
-        self._time_spent = _Minutes(0)
+        self._ledger = ledger
+        self._slot = ledger.allocate()
+        self._version = next(_versions)
         self._inventory = _Inventory()
+        self._inventory._attach(self)
+
+    def __setstate__(self, state):
+        if '_balance' in state:
+            ledger = _Ledger()
+            slot = ledger.allocate()
+            ledger.add(slot,
+                       int(state.pop('_balance')),
+                       int(state.pop('_profit')),
+                       int(state.pop('_time_spent')))
+            state['_ledger'] = ledger
+            state['_slot'] = slot
+        self.__dict__.update(state)
+
+    def _attach(self, ledger, index=True):
+        values = self._ledger.values(self._slot)
+        self._ledger = ledger
+        self._slot = ledger.allocate()
+        self._version = next(_versions)
+        ledger.add(self._slot, *values)
+        if self._inventory is not None:
+            self._inventory._attach(self, index)
+
+    def _unload(self, source):
+        self._inventory = None
+        self._source = source
+
+    def _unload_stored(self, stored):
+        self._inventory = None
+        self._stored = stored
+
+    def _release(self):
+        if self._inventory is not None:
+            self._inventory._detach()
+        self._ledger.release(self._slot)
+        self._slot = None
+
+    def slot(self):
+        return self._slot
+
+    def labels(self):
+        return self._ledger.labels()
 
     def name(self):
         return self._name
@@ -317,87 +1105,139 @@ class _Branch:
     def description(self):
         return self._description
 
+    def _touch(self):
+        self._version = next(_versions)
+        self._ledger.touch()
+
     def rename(self, name):
         _check_type(name, str)
         self._name = name
+        self._touch()
 
     def describe(self, description):
         _check_type(description, str)
         self._description = description
+        self._touch()
 
     def balance(self):
-        return self._balance
+        return _Balance._raw(self._ledger.balance(self._slot))
 
     def profit(self):
-        return self._profit
+        return _Cents._raw(self._ledger.profit(self._slot))
 
     def time_spent(self):
-        return self._time_spent
+        return _Minutes._raw(self._ledger.minutes(self._slot))
 
     def wage(self):
-        return _Wage(self._profit, self._time_spent)
+        return _Wage(self.profit(), self.time_spent())
 
     def deposit(self, cents):
-        self._balance += cents
+        cents.check_positive()
+        self._add(cents._cents, 0, 0)
 
     def withdraw(self, cents):
-        self._balance -= cents
+        cents.check_positive()
+        self._add(-cents._cents, 0, 0)
 
     def earn(self, cents):
-        self._balance += cents
-        self._profit += cents
+        cents.check_positive()
+        self._add(cents._cents, cents._cents, 0)
 
     def spend(self, cents):
-        self._balance -= cents
-        self._profit -= cents
+        cents.check_positive()
+        self._add(-cents._cents, -cents._cents, 0)
 
     def clock(self, minutes_spent):
-        self._time_spent += minutes_spent
+        self._add(0, 0, minutes_spent._minutes)
+
+    def _add(self, cents_deposited, cents_earned, minutes_spent):
+        self._ledger.add(self._slot, cents_deposited, cents_earned, minutes_spent)
+        self._version = next(_versions)
 
     def inventory(self):
+        if self._inventory is None:
+            with _state_lock:
+                if self._inventory is None:
+                    if self._stored is not None:
+                        self._inventory = _database_inventory(*self._stored)
+                        self._stored = None
+                    else:
+                        self._inventory = _read_inventory(*self._source)
+                        self._source = None
+                    self._inventory._attach(self)
         return self._inventory
 
     def _split_name(self, ways):
-        for i in range(ways):
-            yield f'{self._name} ({i+1})'
+        return _split_names(self._name, ways)
 
     def split(self, ways):
         _check_minimum(ways, 2)
-        names       = self._split_name(ways)
-        balances    = self._balance.split(ways)
-        profits     = self._profit.split(ways)
-        times_spent = self._time_spent.split(ways)
-        inventories = self._inventory.split(ways)
-        zipper = zip(names, balances, profits, times_spent, inventories)
-        for name, balance, profit, time_spent, inventory in zipper:
-            child = _Branch(name, self._description)
-            child._balance      = balance
-            child._profit       = profit
-            child._time_spent   = time_spent
-            child._inventory    = inventory
-            yield child
+        inventories = self.inventory().split(ways)
+        balance, profit, minutes = self._ledger.values(self._slot)
+        children = [_Branch(name, self._description, self._ledger)
+                    for name in self._split_name(ways)]
+        self._release()
+        zipper = zip(children,
+                     _split_int(balance, ways),
+                     _split_int(profit, ways),
+                     _split_int(minutes, ways),
+                     inventories)
+        for child, balance, profit, minutes, inventory in zipper:
+            child._add(balance, profit, minutes)
+            child._inventory = inventory
+            inventory._attach(child)
+        return children
 
     def merge(self, other):
-        _check_type(other, _Branch)
-        self._balance       += other._balance.as_cents()
-        self._profit        += other._profit
-        self._time_spent    += other._time_spent
-        self._inventory.merge(other._inventory)
-
+        self.merge_many([other])
+
+    def merge_many(self, others):
+        for index, other in enumerate(others):
+            _check_type(other, _Branch)
+            if other is self or other in others[:index]:
+                raise ValueError(other.name())
+        self.inventory().merge_many([other.inventory() for other in others])
+        for other in others:
+            values = other._ledger.values(other._slot)
+            other._release()
+            self._add(*values)
+
+_ledger = _Ledger()
 _branches = _SortedDict()
 _branches['Initial'] = _Branch('Initial', 'no description')
 
 def _branch_total(get):
     return sum(int(get(branch)) for branch in _branches.values())
 
+def _recount_totals():
+    totals = _Totals()
+    totals.add(_branch_total(_Branch.balance),
+               _branch_total(_Branch.profit),
+               _branch_total(_Branch.time_spent))
+    return totals
+
+_verify_totals = False
+
+def _check_totals():
+    if _recount_totals() != _ledger.totals():
+        raise _ErrInconsistent(_ledger.totals())
+
+def _shop_totals():
+    if _verify_totals:
+        _check_totals()
+    return _ledger.totals()
+
+def _slots():
+    return [branch.slot() for branch in _branches.values()]
+
 def _total_balance():
-    return _Balance(_branch_total(_Branch.balance))
+    return _shop_totals().balance()
 
 def _total_profit():
-    return _Cents(_branch_total(_Branch.profit))
+    return _shop_totals().profit()
 
 def _total_time_spent():
-    return _Minutes(_branch_total(_Branch.time_spent))
+    return _shop_totals().time_spent()
 
 def _total_wage():
     return _Wage(_total_profit(), _total_time_spent())
@@ -405,28 +1245,40 @@ def _total_wage():
 def _check_balance(cents):
     _total_balance().check(cents)
 
-def _cumulative_balance_distribution():
-    total = int(_total_balance())
-    so_far = 0
-    for branch in _branches.values():
-        so_far += int(branch.balance())
-        cumulative_ratio = so_far / total
-        yield branch, cumulative_ratio
-
-def _int_distribution_by_balance(total):
+def _largest_remainder_shares(weights, total_weight, total):
     _check_minimum(total, 0)
-    distributed = 0
-    for branch, cumulative_ratio in _cumulative_balance_distribution():
-        target = int(total * cumulative_ratio)
-        distribution = target - distributed
-        yield branch, distribution
-        distributed = target
-
-def _distribute_by_balance(total, into):
-    typ = type(total)
-    for branch, distribution_int in _int_distribution_by_balance(int(total)):
-        distribution = typ(distribution_int)
-        into(branch, distribution)
+    if total_weight == 0:
+        return list(_split_int(total, len(weights)))
+    products = [total * weight for weight in weights]
+    shares = [product // total_weight for product in products]
+    remainders = [product % total_weight for product in products]
+    leftover = total - sum(shares)
+    for index in nlargest(leftover, range(len(weights)), key=remainders.__getitem__):
+        shares[index] += 1
+    return shares
+
+def _distributions_by_balance(totals, direction):
+    balances = _ledger.balances(_slots())
+    total_balance = sum(balances)
+    distributions = []
+    for total in totals:
+        shares = _largest_remainder_shares(balances, total_balance, total)
+        distributions.append(shares)
+        if direction != 0:
+            balances = [balance + direction * share
+                        for balance, share in zip(balances, shares)]
+            total_balance += direction * total
+    return distributions
+
+def _distribute_by_balance(totals, deposited, earned, spent):
+    distributions = _distributions_by_balance(totals, deposited)
+    summed = [sum(shares) for shares in zip(*distributions)]
+    for branch, distribution in zip(list(_branches.values()), summed):
+        if distribution != 0:
+            branch._add(deposited * distribution,
+                        earned * distribution,
+                        spent * distribution)
+    return distributions
 
 def _convert_table_data(data):
     return [[str(cell) for cell in row] for row in data]
@@ -455,9 +1307,7 @@ def _convert_alignments(alignments):
 def _convert_paddings(paddings):
     return [' ' * int(padding) for padding in paddings]
 
-def _table(data, alignments, paddings):
-    data = _convert_table_data(data)
-    column_widths = _column_widths(data)
+def _table_rows(data, alignments, paddings, column_widths):
     num_columns = len(column_widths)
     if len(alignments) != num_columns:
         raise ValueError(alignments)
@@ -465,14 +1315,365 @@ def _table(data, alignments, paddings):
         raise ValueError(paddings)
     alignments  = _convert_alignments(alignments)
     paddings    = _convert_paddings(paddings)
-    rows = (
+    return (
         ''.join(
             f'{paddings[column]}{cell:{alignments[column]}{column_widths[column]}}'
             for column, cell in enumerate(row))
         for row in data)
-    return '\n'.join(rows)
 
-_history = []
+def _table(data, alignments, paddings):
+    data = _convert_table_data(data)
+    column_widths = _column_widths(data)
+    return '\n'.join(_table_rows(data, alignments, paddings, column_widths))
+
+_width_sample = 1000
+_page_size = 50
+_render_budget = 16 * 1024 * 1024
+_render_rows = 1000
+_render_cache = OrderedDict()
+_render_size = 0
+
+def _cached_text(key, render):
+    global _render_size
+    text = _render_cache.get(key)
+    if text is not None:
+        _render_cache.move_to_end(key)
+        return text
+    text = render()
+    size = sys.getsizeof(text)
+    if size <= _render_budget:
+        _render_cache[key] = text
+        _render_size += size
+        while _render_size > _render_budget:
+            _, evicted = _render_cache.popitem(last=False)
+            _render_size -= sys.getsizeof(evicted)
+    return text
+
+def _write_cached(key, write, file=None, cache=True):
+    def render():
+        buffer = io.StringIO()
+        write(buffer)
+        return buffer.getvalue()
+    if file is None:
+        file = sys.stdout
+    if cache:
+        file.write(_cached_text(key, render))
+    else:
+        write(file)
+
+def _short_page(page, limit):
+    # Whole tables and long pages stream straight to the file instead of
+    # being rendered into the cache first.
+    if limit is None:
+        return page is not None
+    return isinstance(limit, int) and limit <= _render_rows
+
+def _write_table(data, alignments, paddings, file=None):
+    if file is None:
+        file = sys.stdout
+    data = ([str(cell) for cell in row] for row in data)
+    sample = list(islice(data, _width_sample))
+    column_widths = _column_widths(sample)
+    for row in _table_rows(chain(sample, data), alignments, paddings, column_widths):
+        file.write(f'{row}\n')
+
+def _page_range(count, page, offset, limit):
+    if page is not None:
+        page = _RowNum(page)
+        if limit is None:
+            limit = _page_size
+        offset = page.index() * limit
+    _check_type(offset, int)
+    _check_minimum(offset, 0)
+    if limit is None:
+        return offset, count
+    _check_type(limit, int)
+    _check_minimum(limit, 0)
+    return offset, min(count, offset + limit)
+
+_OP_TEXT            = 0
+_OP_SHOP_DEPOSIT    = 1
+_OP_SHOP_WITHDRAW   = 2
+_OP_SHOP_EARN       = 3
+_OP_SHOP_SPEND      = 4
+_OP_SHOP_CLOCK      = 5
+_OP_DEPOSIT         = 6
+_OP_WITHDRAW        = 7
+_OP_EARN            = 8
+_OP_SPEND           = 9
+_OP_CLOCK           = 10
+_OP_RENAME          = 11
+_OP_DESCRIBE        = 12
+_OP_SPLIT           = 13
+_OP_MERGE           = 14
+_OP_RELABEL         = 15
+_OP_ACQUIRE         = 16
+_OP_DISCARD         = 17
+_OP_BUY             = 18
+_OP_SELL            = 19
+_OP_TRUNCATE        = 254
+_OP_STRING          = 255
+
+_op_names = ['text',
+             'deposit', 'withdraw', 'earn', 'spend', 'clock',
+             'deposit', 'withdraw', 'earn', 'spend', 'clock',
+             'rename', 'describe', 'split', 'merge',
+             'relabel', 'acquire', 'discard', 'buy', 'sell']
+
+def _dollars_text(cents):
+    sign = '-' if cents < 0 else ''
+    dollars, cents = divmod(abs(cents), 100)
+    if cents == 0:
+        return f'{sign}{dollars}'
+    else:
+        return f'{sign}{dollars}.{cents:02}'.rstrip('0')
+
+def _hours_text(minutes):
+    if minutes % 60 == 0:
+        return str(minutes // 60)
+    else:
+        return str(minutes / 60)
+
+class _Log:
+
+    _record_struct = struct.Struct('<Biiiqqq')
+    _replayable = 0
+    _mirrored = 0
+
+    def __init__(self):
+        self._ops = array('B')
+        self._branches = array('i')
+        self._labels = array('i')
+        self._texts = array('i')
+        self._units = array('q')
+        self._amounts = array('q')
+        self._times = array('q')
+        self._strings = []
+        self._string_ids = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_string_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._string_ids = {string: id for id, string in enumerate(self._strings)}
+        if '_times' not in state:
+            self._times = array('q', [0]) * len(self._ops)
+
+    def __len__(self):
+        return len(self._ops)
+
+    def copy(self):
+        log = _Log()
+        log._ops = self._ops[:]
+        log._branches = self._branches[:]
+        log._labels = self._labels[:]
+        log._texts = self._texts[:]
+        log._units = self._units[:]
+        log._amounts = self._amounts[:]
+        log._times = self._times[:]
+        log._strings = self._strings[:]
+        log._string_ids = self._string_ids.copy()
+        return log
+
+    def mirror(self, log=None):
+        # Brings a copy made by an earlier call up to date, copying only the
+        # records appended since then and any that replaced undone ones.
+        if log is None:
+            log = self.copy()
+        else:
+            kept = min(self._mirrored, len(log))
+            log.truncate(kept)
+            for name in _log_columns:
+                getattr(log, name).extend(getattr(self, name)[kept:])
+            for string in self._strings[log.num_strings():]:
+                log._intern(string)
+        self._mirrored = len(self)
+        return log
+
+    def _intern(self, string):
+        if string is None:
+            return -1
+        id = self._string_ids.get(string)
+        if id is None:
+            id = len(self._strings)
+            self._strings.append(string)
+            self._string_ids[string] = id
+        return id
+
+    def append(self, op, branch=None, label=None, units=0, amount=0, text=None, timestamp=None):
+        self.append_ids(op, self._intern(branch), self._intern(label),
+                        self._intern(text), units, amount, timestamp)
+
+    def append_ids(self, op, branch, label, text, units, amount, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        self._ops.append(op)
+        self._branches.append(branch)
+        self._labels.append(label)
+        self._texts.append(text)
+        self._units.append(units)
+        self._amounts.append(amount)
+        self._times.append(timestamp)
+
+    def truncate(self, length):
+        for column in [self._ops, self._branches, self._labels,
+                       self._texts, self._units, self._amounts, self._times]:
+            del column[length:]
+        self._replayable = min(self._replayable, length)
+        self._mirrored = min(self._mirrored, length)
+
+    def time_at(self, index):
+        return self._times[index]
+
+    def record_at(self, index):
+        return (self._ops[index], self._branches[index], self._labels[index],
+                self._texts[index], self._units[index], self._amounts[index])
+
+    def string(self, id):
+        return self._strings[id]
+
+    def num_strings(self):
+        return len(self._strings)
+
+    def add_string(self, string):
+        _check_type(string, str)
+        self._intern(string)
+
+    def render(self, op, branch, label, text, units, amount):
+        if op == _OP_TEXT:
+            return self._strings[text]
+        name = _op_names[op]
+        if op <= _OP_SHOP_SPEND:
+            return f'{name}({_dollars_text(amount)})'
+        elif op == _OP_SHOP_CLOCK:
+            return f'{name}({_hours_text(amount)})'
+        string = f'branch({self._strings[branch]!r})'
+        if op <= _OP_SPEND:
+            return f'{string}.{name}({_dollars_text(amount)})'
+        elif op == _OP_CLOCK:
+            return f'{string}.{name}({_hours_text(amount)})'
+        elif op <= _OP_DESCRIBE:
+            return f'{string}.{name}({self._strings[text]!r})'
+        elif op == _OP_SPLIT:
+            return f'{string}.{name}({amount})'
+        elif op == _OP_MERGE:
+            return f'{string}.{name}(branch({self._strings[text]!r}))'
+        string = f'{string}.item({self._strings[label]!r})'
+        if units != 1:
+            string = f'{string}.units({units})'
+        if op == _OP_RELABEL:
+            return f'{string}.{name}({self._strings[text]!r})'
+        elif op <= _OP_DISCARD:
+            return f'{string}.{name}()'
+        else:
+            return f'{string}.{name}({_dollars_text(amount)})'
+
+    def entry(self, index):
+        return self.render(*self.record_at(index))
+
+    def entries(self):
+        for index in range(len(self)):
+            yield self.entry(index)
+
+    def pack(self, start, stop, strings_from):
+        packed = []
+        for string in self._strings[strings_from:]:
+            data = string.encode('utf-8')
+            packed.append(self._record_struct.pack(_OP_STRING, 0, 0, 0, len(data), 0, 0))
+            packed.append(data)
+        for index in range(start, stop):
+            packed.append(self._record_struct.pack(*self.record_at(index), self._times[index]))
+        return b''.join(packed)
+
+    def check(self):
+        columns = [self._branches, self._labels, self._texts,
+                   self._units, self._amounts, self._times]
+        for column in columns:
+            if len(column) != len(self._ops):
+                raise ValueError(column)
+        for column in columns[:3]:
+            if not -1 <= min(column, default=-1) <= max(column, default=-1) < len(self._strings):
+                raise ValueError(column)
+        if max(self._ops, default=0) >= len(_op_names):
+            raise ValueError(self._ops)
+        for string in self._strings:
+            _check_type(string, str)
+
+    def check_replayable(self):
+        start = min(self._replayable, len(self))
+        ops = self._ops[start:]
+        if _OP_TEXT in ops:
+            raise ValueError(self.entry(start + ops.index(_OP_TEXT)))
+        if min(self._units[start:], default=0) < 0:
+            raise ValueError(min(self._units[start:]))
+        if min(self._amounts[start:], default=0) < 0:
+            raise ValueError(min(self._amounts[start:]))
+        self._replayable = len(self)
+
+    def from_entries(entries):
+        _check_type(entries, list)
+        log = _Log()
+        for entry in entries:
+            _check_type(entry, str)
+            log.append(_OP_TEXT, text=entry, timestamp=0)
+        return log
+
+_history = _Log()
+
+def _rename_branch(branch, name):
+    del _branches[branch.name()]
+    branch.rename(name)
+    _branches[name] = branch
+
+def _split_branch(branch, ways):
+    _check_minimum(ways, 2)
+    for name in branch._split_name(ways):
+        if name in _branches:
+            raise ValueError(name)
+    children = branch.split(ways)
+    del _branches[branch.name()]
+    for child in children:
+        _branches[child.name()] = child
+
+def _merge_branches(branch, others):
+    branch.merge_many(others)
+    for other in others:
+        del _branches[other.name()]
+
+_state_lock = threading.RLock()
+
+def _writes(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with _state_lock:
+            return function(*args, **kwargs)
+    return wrapper
+
+def _record(op, branch=None, label=None, units=0, amount=0, text=None):
+    _history.append(op, branch, label, units, amount, text)
+    _recorded(len(_history) - 1)
+
+def _recorded(start, redone=False):
+    global _journal_entries
+    global _journal_strings
+    if not redone:
+        _redo.clear()
+    if _journal is not None:
+        _journal.write(_history.pack(start, len(_history), _journal_strings))
+        _journal.flush()
+        _journal_strings = _history.num_strings()
+        _journal_entries += len(_history) - start
+        if _journal_entries >= _journal_limit:
+            _compact()
+    _checkpoint_recorded()
+    if _server is not None:
+        _publish(_touched(_history, start, len(_history)))
+    _mark_dirty()
+    if _database is not None:
+        _store(start)
 
 class _ItemInterface:
 
@@ -481,10 +1682,10 @@ class _ItemInterface:
         _check_type(label, str)
         self._branch = branch
         self._label = label
-        self._units = _Units(1)
+        self._units = _Units._raw(1)
 
     def __str__(self):
-        string = f'branch(\'{self._branch.name()}\').item(\'{self._label}\')'
+        string = f'branch({self._branch.name()!r}).item({self._label!r})'
         if int(self._units) == 1:
             return string
         else:
@@ -493,35 +1694,77 @@ class _ItemInterface:
     def _inventory(self):
         return self._branch.inventory()
 
+    def _record(self, op, amount=0, text=None):
+        _record(op, self._branch.name(), self._label, int(self._units), amount, text)
+
     def units(self, units):
         self._units = _Units(units)
         return self
 
+    def summary(self):
+        inventory = self._inventory()
+        data = [['Units', 'Cost', 'Realized Profit'],
+                [_Units._raw(inventory.held(self._label)),
+                 inventory.cost(self._label),
+                 inventory.realized(self._label)]]
+        print(_table(data, 'rrr', '033'))
+
+    @_writes
     def relabel(self, label):
         self._inventory().relabel(self._label, label, self._units)
+        self._record(_OP_RELABEL, text=label)
         self._label = label
-        _history.append(f'{self}.relabel(\'{label}\')')
 
+    @_writes
     def acquire(self):
         self._inventory().acquire(self._label, self._units)
-        _history.append(f'{self}.acquire()')
+        self._record(_OP_ACQUIRE)
 
+    @_writes
     def discard(self):
-        self._inventory().discard(self._label, self._units)
-        _history.append(f'{self}.discard()')
+        taken = self._inventory().discard(self._label, self._units)
+        _remember(len(_history), taken)
+        self._record(_OP_DISCARD)
 
+    @_writes
     def buy(self, dollars_spent):
         cents_spent = _Cents.from_dollars(dollars_spent)
         self._branch.spend(cents_spent)
-        self.acquire()
-        _history.append(f'{self}.buy({dollars_spent})')
+        self._inventory().buy(self._label, self._units, cents_spent)
+        self._record(_OP_BUY, int(cents_spent))
 
+    @_writes
     def sell(self, dollars_earned):
         cents_earned = _Cents.from_dollars(dollars_earned)
         cents_earned.check_positive()
-        self.discard()
+        taken = self._inventory().sell(self._label, self._units, cents_earned)
         self._branch.earn(cents_earned)
-        _history.append(f'{self}.sell({dollars_earned})')
+        _remember(len(_history), taken)
+        self._record(_OP_SELL, int(cents_earned))
+
+def _write_inventory(inventory, page, offset, limit, file, first=0, last=None):
+    if last is None:
+        last = len(inventory)
+    start, stop = _page_range(last - first, page, offset, limit)
+    start += first
+    stop += first
+    rows = ([_RowNum.from_index(index), label, units]
+            for index, (label, units)
+            in enumerate(inventory.items_at(start, stop), start))
+    _write_table(chain([['', '', 'Units']], rows), 'llr', '013', file)
+
+def _print_counts(labels, units):
+    print(_table([['Labels', 'Units'], [labels, _Units._raw(units)]], 'rr', '03'))
+
+def _check_top(n, by):
+    _check_type(n, int)
+    _check_minimum(n, 0)
+    if by not in ('units', 'value'):
+        raise ValueError(by)
+
+def _top_rows(ranked, n):
+    for rank, (_, label, *rest) in enumerate(islice(ranked, n)):
+        yield [_RowNum.from_index(rank), label, *rest]
 
 class _BranchInterface:
 
@@ -530,7 +1773,10 @@ class _BranchInterface:
         self._branch = branch
 
     def __str__(self):
-        return f'branch(\'{self._branch.name()}\')'
+        return f'branch({self._branch.name()!r})'
+
+    def _record(self, op, amount=0, text=None):
+        _record(op, self._branch.name(), amount=amount, text=text)
 
     def name(self):
         print(self._branch.name())
@@ -538,58 +1784,100 @@ class _BranchInterface:
     def description(self):
         print(self._branch.description())
 
+    @_writes
     def rename(self, name):
         _check_type(name, str)
         if name in _branches:
             raise ValueError(name)
-        _history.append(f'{self}.rename(\'{name}\')')
-        del _branches[self._branch.name()]
-        self._branch.rename(name)
-        _branches[self._branch.name()] = self._branch
+        old_name = self._branch.name()
+        _rename_branch(self._branch, name)
+        _record(_OP_RENAME, old_name, text=name)
 
+    @_writes
     def describe(self, description):
+        old_description = self._branch.description()
         self._branch.describe(description)
-        _history.append(f'{self}.describe(\'{description}\')')
+        _remember(len(_history), old_description)
+        self._record(_OP_DESCRIBE, text=description)
 
     def summary(self):
-        data = [['Balance', 'Profit', 'Time Spent', 'Wage'],
-                [self._branch.balance(),
-                 self._branch.profit(),
-                 self._branch.time_spent(),
-                 self._branch.wage()]]
-        print(_table(data, 'rrrr', '0333'))
-
+        branch = self._branch
+        def write(file):
+            data = [['Balance', 'Profit', 'Time Spent', 'Wage'],
+                    [branch.balance(), branch.profit(), branch.time_spent(), branch.wage()]]
+            _write_table(data, 'rrrr', '0333', file)
+        _write_cached(('branch summary', branch._version), write)
+
+    @_writes
     def deposit(self, dollars):
         cents = _Cents.from_dollars(dollars)
         self._branch.deposit(cents)
-        _history.append(f'{self}.deposit({dollars})')
+        self._record(_OP_DEPOSIT, int(cents))
 
+    @_writes
     def withdraw(self, dollars):
         cents = _Cents.from_dollars(dollars)
         self._branch.withdraw(cents)
-        _history.append(f'{self}.withdraw({dollars})')
+        self._record(_OP_WITHDRAW, int(cents))
 
+    @_writes
     def earn(self, dollars):
         cents = _Cents.from_dollars(dollars)
         self._branch.earn(cents)
-        _history.append(f'{self}.earn({dollars})')
+        self._record(_OP_EARN, int(cents))
 
+    @_writes
     def spend(self, dollars):
         cents = _Cents.from_dollars(dollars)
         self._branch.spend(cents)
-        _history.append(f'{self}.spend({dollars})')
+        self._record(_OP_SPEND, int(cents))
 
+    @_writes
     def clock(self, hours_spent):
         minutes_spent = _Minutes.from_hours(hours_spent)
         self._branch.clock(minutes_spent)
-        _history.append(f'{self}.clock({hours_spent})')
-
-    def inventory(self):
-        data = [['', '', 'Units']]
-        data.extend([_RowNum.from_index(index), label, units]
-                    for index, (label, units)
-                    in enumerate(self._branch.inventory().items()))
-        print(_table(data, 'llr', '013'))
+        self._record(_OP_CLOCK, int(minutes_spent))
+
+    def inventory(self, page=None, offset=0, limit=None, file=None):
+        inventory = self._branch.inventory()
+        _write_cached(('inventory', inventory._version, page, offset, limit),
+                      lambda file: _write_inventory(inventory, page, offset, limit, file),
+                      file, _short_page(page, limit))
+
+    def inventory_between(self, first, last, page=None, offset=0, limit=None, file=None):
+        _check_type(first, str)
+        _check_type(last, str)
+        inventory = self._branch.inventory()
+        start, stop = inventory.index_range(first, last)
+        _write_inventory(inventory, page, offset, limit, file, start, stop)
+
+    def inventory_prefix(self, prefix, page=None, offset=0, limit=None, file=None):
+        _check_type(prefix, str)
+        inventory = self._branch.inventory()
+        start, stop = inventory.prefix_range(prefix)
+        _write_inventory(inventory, page, offset, limit, file, start, stop)
+
+    def _count(self, start, stop):
+        inventory = self._branch.inventory()
+        units = sum(int(units) for _, units in inventory.items_at(start, stop))
+        _print_counts(stop - start, units)
+
+    def count_between(self, first, last):
+        _check_type(first, str)
+        _check_type(last, str)
+        self._count(*self._branch.inventory().index_range(first, last))
+
+    def count_prefix(self, prefix):
+        _check_type(prefix, str)
+        self._count(*self._branch.inventory().prefix_range(prefix))
+
+    def top(self, n=10, by='units'):
+        _check_top(n, by)
+        inventory = self._branch.inventory()
+        ranked = ((score, label, _Units._raw(inventory.held(label)), inventory.cost(label))
+                  for score, label in inventory.ranked(by))
+        rows = _top_rows(ranked, n)
+        print(_table([['', 'Label', 'Units', 'Cost'], *rows], 'llrr', '0133'))
 
     def item(self, num_or_label):
         label = None
@@ -600,21 +1888,28 @@ class _BranchInterface:
             label = self._branch.inventory().label_at(index)
         return _ItemInterface(self._branch, label)
 
+    @_writes
     def split(self, ways):
-        children = list(self._branch.split(ways))
-        for child in children:
-            if child.name() in _branches:
-                raise ValueError(child.name())
-        for child in children:
-            _branches[child.name()] = child
-        del _branches[self._branch.name()]
-        _history.append(f'{self}.split({ways})')
+        _split_branch(self._branch, ways)
+        self._record(_OP_SPLIT, ways)
 
     def merge(self, other):
-        _check_type(other, _BranchInterface)
-        self._branch.merge(other._branch)
-        del _branches[other._branch.name()]
-        _history.append(f'{self}.merge({other})')
+        self.merge_many([other])
+
+    @_writes
+    def merge_many(self, others):
+        _check_type(others, list)
+        for other in others:
+            _check_type(other, _BranchInterface)
+        start = len(_history)
+        merged = [(_branch_row(other._branch), _inventory_data(other._branch.inventory()))
+                  for other in others]
+        _merge_branches(self._branch, [other._branch for other in others])
+        for index, contents in enumerate(merged, start):
+            _remember(index, contents)
+        for other in others:
+            _history.append(_OP_MERGE, self._branch.name(), text=other._branch.name())
+        _recorded(start)
 
 def branch(num_or_name):
     branch = None
@@ -637,56 +1932,353 @@ def branch_descriptions():
         print(branch.description())
         print()
 
-def branch_summaries():
-    data = [['', '', 'Balance', 'Profit', 'Time Spent', 'Wage']]
-    data.extend([_RowNum.from_index(index),
-                 branch.name(),
-                 branch.balance(),
-                 branch.profit(),
-                 branch.time_spent(),
-                 branch.wage()]
-                for index, branch in enumerate(_branches.values()))
-    print(_table(data, 'llrrrr', '013333'))
+def _hourly_cents(profit, minutes):
+    if minutes == 0:
+        return float('-inf')
+    else:
+        return profit * 60 / minutes
+
+def _branch_order(sort_by, balances, profits, minutes):
+    indexes = range(len(balances))
+    if sort_by is None:
+        return indexes
+    elif sort_by == 'balance':
+        key = balances.__getitem__
+    elif sort_by == 'profit':
+        key = profits.__getitem__
+    elif sort_by == 'time':
+        key = minutes.__getitem__
+    elif sort_by == 'wage':
+        wages = list(map(_hourly_cents, profits, minutes))
+        key = wages.__getitem__
+    else:
+        raise ValueError(sort_by)
+    return sorted(indexes, key=key, reverse=True)
+
+def _summary_rows(indexes, names, balances, profits, minutes):
+    for index in indexes:
+        profit = _Cents._raw(profits[index])
+        time_spent = _Minutes._raw(minutes[index])
+        yield [_RowNum.from_index(index),
+               names[index],
+               _Balance._raw(balances[index]),
+               profit,
+               time_spent,
+               _Wage(profit, time_spent)]
+
+def branch_summaries(sort_by=None, page=None, offset=0, limit=None, file=None):
+    _write_cached(('branch summaries', _ledger._version, sort_by, page, offset, limit),
+                  lambda file: _write_branch_summaries(sort_by, page, offset, limit, file),
+                  file, _short_page(page, limit))
+
+def _write_branch_summaries(sort_by, page, offset, limit, file):
+    slots = _slots()
+    _write_summaries(list(_branches.keys()), _ledger.balances(slots), _ledger.profits(slots),
+                     _ledger.times_spent(slots), sort_by, page, offset, limit, file)
+
+def _write_summaries(names, balances, profits, minutes, sort_by, page, offset, limit, file):
+    start, stop = _page_range(len(names), page, offset, limit)
+    indexes = _branch_order(sort_by, balances, profits, minutes)[start:stop]
+    rows = _summary_rows(indexes, names, balances, profits, minutes)
+    header = [['', '', 'Balance', 'Profit', 'Time Spent', 'Wage']]
+    _write_table(chain(header, rows), 'llrrrr', '013333', file)
+
+def _print_holders(labels):
+    data = [['Label', 'Branch', 'Units']]
+    for label, holders in labels:
+        for name, units in sorted((branch.name(), units) for branch, units in holders.items()):
+            data.append([label, name, _Units._raw(units)])
+    print(_table(data, 'llr', '033'))
+
+def _load_inventories():
+    for branch in _branches.values():
+        branch.inventory()
+
+def where(label):
+    _check_type(label, str)
+    _load_inventories()
+    _print_holders([(label, _ledger.labels().holders(label))])
+
+def where_prefix(prefix):
+    _check_type(prefix, str)
+    _load_inventories()
+    _print_holders(_ledger.labels().prefixed(prefix))
+
+def where_between(first, last):
+    _check_type(first, str)
+    _check_type(last, str)
+    _load_inventories()
+    _print_holders(_ledger.labels().between(first, last))
+
+def count_between(first, last):
+    _check_type(first, str)
+    _check_type(last, str)
+    _load_inventories()
+    _print_counts(*_ledger.labels().count(first, last))
+
+def count_prefix(prefix):
+    _check_type(prefix, str)
+    _load_inventories()
+    _print_counts(*_ledger.labels().count(prefix, _prefix_end(prefix)))
+
+def _ranked_rows(name, inventory, by):
+    for score, label in inventory.ranked(by):
+        yield score, label, name, inventory
+
+def top(n=10, by='units'):
+    _check_top(n, by)
+    _load_inventories()
+    ranked = ((score, label, name, _Units._raw(inventory.held(label)), inventory.cost(label))
+              for score, label, name, inventory
+              in merge_sorted(*(_ranked_rows(name, branch.inventory(), by)
+                                for name, branch in _branches.items())))
+    rows = _top_rows(ranked, n)
+    print(_table([['', 'Label', 'Branch', 'Units', 'Cost'], *rows], 'lllrr', '01333'))
 
 def summary():
-    data = [['Balance', 'Profit', 'Time Spent', 'Wage'],
-            [_total_balance(),
-             _total_profit(),
-             _total_time_spent(),
-             _total_wage()]]
-    print(_table(data, 'rrrr', '0333'))
+    def write(file):
+        data = [['Balance', 'Profit', 'Time Spent', 'Wage'],
+                [_total_balance(),
+                 _total_profit(),
+                 _total_time_spent(),
+                 _total_wage()]]
+        _write_table(data, 'rrrr', '0333', file)
+    _write_cached(('summary', _ledger._version), write)
+
+def _one_or_many(amounts):
+    if type(amounts) is list:
+        return amounts
+    else:
+        return [amounts]
+
+def _shop_cents(dollars):
+    cents = [_Cents.from_dollars(each) for each in _one_or_many(dollars)]
+    for each in cents:
+        each.check_positive()
+    return [int(each) for each in cents]
 
+def _shop_minutes(hours_spent):
+    return [int(_Minutes.from_hours(each)) for each in _one_or_many(hours_spent)]
+
+def _record_amounts(op, amounts, distributions):
+    start = len(_history)
+    for amount, shares in zip(amounts, distributions):
+        _remember(len(_history), shares)
+        _history.append(op, amount=amount)
+    _recorded(start)
+
+@_writes
 def deposit(dollars):
-    cents = _Cents.from_dollars(dollars)
-    _distribute_by_balance(cents, _Branch.deposit)
-    _history.append(f'deposit({dollars})')
+    cents = _shop_cents(dollars)
+    distributions = _distribute_by_balance(cents, 1, 0, 0)
+    _record_amounts(_OP_SHOP_DEPOSIT, cents, distributions)
 
+@_writes
 def withdraw(dollars):
-    cents = _Cents.from_dollars(dollars)
-    _check_balance(cents)
-    _distribute_by_balance(cents, _Branch.withdraw)
-    _history.append(f'withdraw({dollars})')
+    cents = _shop_cents(dollars)
+    _check_balance(_Cents(sum(cents)))
+    distributions = _distribute_by_balance(cents, -1, 0, 0)
+    _record_amounts(_OP_SHOP_WITHDRAW, cents, distributions)
 
+@_writes
 def earn(dollars):
-    cents = _Cents.from_dollars(dollars)
-    _distribute_by_balance(cents, _Branch.earn)
-    _history.append(f'earn({dollars})')
+    cents = _shop_cents(dollars)
+    distributions = _distribute_by_balance(cents, 1, 1, 0)
+    _record_amounts(_OP_SHOP_EARN, cents, distributions)
 
+@_writes
 def spend(dollars):
-    cents = _Cents.from_dollars(dollars)
-    _check_balance(cents)
-    _distribute_by_balance(cents, _Branch.spend)
-    _history.append(f'spend({dollars})')
+    cents = _shop_cents(dollars)
+    _check_balance(_Cents(sum(cents)))
+    distributions = _distribute_by_balance(cents, -1, -1, 0)
+    _record_amounts(_OP_SHOP_SPEND, cents, distributions)
 
+@_writes
 def clock(hours_spent):
-    minutes_spent = _Minutes.from_hours(hours_spent)
-    _distribute_by_balance(minutes_spent, _Branch.clock)
-    _history.append(f'clock({hours_spent})')
+    minutes_spent = _shop_minutes(hours_spent)
+    distributions = _distribute_by_balance(minutes_spent, 0, 0, 1)
+    _record_amounts(_OP_SHOP_CLOCK, minutes_spent, distributions)
 
 def history():
-    print('\n'.join(_history))
-
-import pickle
+    print('\n'.join(_history.entries()))
+
+def _shop_replayer(deposited, earned, spent):
+    def replay(strings, branch, label, text, units, amount):
+        if deposited < 0 and int(_total_balance()) < amount:
+            raise _ErrInsufficient(_total_balance())
+        _distribute_by_balance([amount], deposited, earned, spent)
+    return replay
+
+def _branch_replayer(deposited, earned, spent):
+    def replay(strings, branch, label, text, units, amount):
+        _branches[strings[branch]]._add(deposited * amount, earned * amount, spent * amount)
+    return replay
+
+def _replay_rename(strings, branch, label, text, units, amount):
+    name = strings[text]
+    if name in _branches:
+        raise ValueError(name)
+    _rename_branch(_branches[strings[branch]], name)
+
+def _replay_describe(strings, branch, label, text, units, amount):
+    _branches[strings[branch]]._description = strings[text]
+
+def _replay_split(strings, branch, label, text, units, amount):
+    _split_branch(_branches[strings[branch]], amount)
+
+def _replay_merge(strings, branch, label, text, units, amount):
+    _merge_branches(_branches[strings[branch]], [_branches[strings[text]]])
+
+def _replay_relabel(strings, branch, label, text, units, amount):
+    _branches[strings[branch]].inventory()._relabel(strings[label], strings[text], units)
+
+def _replay_acquire(strings, branch, label, text, units, amount):
+    _branches[strings[branch]].inventory()._acquire(strings[label], units)
+
+def _replay_discard(strings, branch, label, text, units, amount):
+    _branches[strings[branch]].inventory()._discard(strings[label], units)
+
+def _replay_buy(strings, branch, label, text, units, amount):
+    branch = _branches[strings[branch]]
+    branch._add(-amount, -amount, 0)
+    branch.inventory()._acquire(strings[label], units, amount)
+
+def _replay_sell(strings, branch, label, text, units, amount):
+    branch = _branches[strings[branch]]
+    branch.inventory()._sell(strings[label], units, amount)
+    branch._add(amount, amount, 0)
+
+_replayers = [None,
+              _shop_replayer(1, 0, 0),
+              _shop_replayer(-1, 0, 0),
+              _shop_replayer(1, 1, 0),
+              _shop_replayer(-1, -1, 0),
+              _shop_replayer(0, 0, 1),
+              _branch_replayer(1, 0, 0),
+              _branch_replayer(-1, 0, 0),
+              _branch_replayer(1, 1, 0),
+              _branch_replayer(-1, -1, 0),
+              _branch_replayer(0, 0, 1),
+              _replay_rename,
+              _replay_describe,
+              _replay_split,
+              _replay_merge,
+              _replay_relabel,
+              _replay_acquire,
+              _replay_discard,
+              _replay_buy,
+              _replay_sell]
+
+def _apply(log, start, stop):
+    replayers = _replayers
+    strings = log._strings
+    records = zip(log._ops, log._branches, log._labels, log._texts, log._units, log._amounts)
+    for op, branch, label, text, units, amount in islice(records, start, stop):
+        replayers[op](strings, branch, label, text, units, amount)
+
+_order_columns = {'kind':       'Type',
+                  'branch':     'Branch',
+                  'label':      'Custom label (SKU)',
+                  'units':      'Quantity',
+                  'dollars':    'Total price'}
+
+_order_kinds = {'buy': _OP_BUY, 'sell': _OP_SELL}
+
+def _order_rows(file_name):
+    with open(file_name, newline='', encoding='utf-8-sig') as file:
+        if file_name.endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        elif file_name.endswith('.json'):
+            yield from json.load(file)
+        else:
+            yield from csv.DictReader(file)
+
+def _cents_from_text(text):
+    dollars = Decimal(str(text).strip().replace('$', '').replace(',', ''))
+    cents = dollars * 100
+    if cents != cents.to_integral_value():
+        raise ValueError(text)
+    return int(cents)
+
+def _units_from_value(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    units = Decimal(str(value).strip())
+    if units != units.to_integral_value():
+        raise ValueError(value)
+    return int(units)
+
+def _parse_orders(rows, kind, branch_name, columns):
+    for row in rows:
+        try:
+            op = _order_kinds[(kind or row[columns['kind']]).strip().lower()]
+            name = branch_name or row[columns['branch']]
+            label = row[columns['label']]
+            units = _units_from_value(row[columns['units']])
+            cents = _cents_from_text(row[columns['dollars']])
+        except (KeyError, ValueError, ArithmeticError, AttributeError, TypeError):
+            raise ValueError(row)
+        _check_type(name, str)
+        _check_type(label, str)
+        _check_minimum(units, 1)
+        _check_minimum(cents, 0)
+        yield op, name, label, units, cents
+
+def _read_orders(file_name, kind, branch_name, columns):
+    return _parse_orders(_order_rows(file_name), kind, branch_name, columns)
+
+def _check_orders(orders):
+    balances = {}
+    held = {}
+    count = 0
+    for op, name, label, units, cents in orders:
+        if name not in _branches:
+            raise KeyError(name)
+        if name not in balances:
+            balances[name] = int(_branches[name].balance())
+        key = name, label
+        if key not in held:
+            inventory = _branches[name].inventory()._dict
+            held[key] = int(inventory[label]) if label in inventory else 0
+        if op == _OP_BUY:
+            if balances[name] < cents:
+                raise _ErrInsufficient(_Balance(balances[name]))
+            balances[name] -= cents
+            held[key] += units
+        else:
+            if held[key] < units:
+                raise _ErrInsufficient(_Units(held[key]))
+            balances[name] += cents
+            held[key] -= units
+        count += 1
+    return count
+
+def _apply_orders(orders):
+    for op, name, label, units, cents in orders:
+        branch = _branches[name]
+        if op == _OP_BUY:
+            branch._add(-cents, -cents, 0)
+            branch.inventory()._acquire(label, units, cents)
+        else:
+            _remember(len(_history), branch.inventory()._sell(label, units, cents))
+            branch._add(cents, cents, 0)
+        _history.append(op, name, label, units, cents)
+
+@_writes
+def import_orders(file_name, kind=None, branch_name=None, columns=None):
+    columns = {**_order_columns, **(columns or {})}
+    count = _check_orders(_read_orders(file_name, kind, branch_name, columns))
+    start = len(_history)
+    try:
+        _apply_orders(_read_orders(file_name, kind, branch_name, columns))
+    finally:
+        # The whole import is journaled, stored, checkpointed, published and
+        # autosaved as one command, so nobody sees it half applied.
+        if len(_history) > start:
+            _recorded(start)
+    print(f'{count} orders imported')
 
 def _check_branches(branches):
     _check_type(branches, _SortedDict)
@@ -697,35 +2289,1733 @@ def _check_branches(branches):
             raise ValueError(name)
 
 def _check_history(history):
-    _check_type(history, list)
-    for entry in history:
-        _check_type(entry, str)
+    _check_type(history, _Log)
+    history.check()
 
 def _set_state(state):
+    global _ledger
     global _branches
     global _history
     branches, history = state
+    if type(history) is list:
+        history = _Log.from_entries(history)
     _check_branches(branches)
     _check_history(history)
+    ledger = _Ledger()
+    for branch in branches.values():
+        branch._attach(ledger, index=False)
+    ledger.labels().add_branches(branches.values())
+    _ledger = ledger
     _branches = branches
     _history = history
 
 def _get_state():
     return _branches, _history
 
-def save(file_name):
-    file = open(file_name, 'wb')
-    contents = _get_state()
-    pickle.dump(contents, file)
+def _branch_row(branch):
+    return (branch.name(), branch.description(), *branch._ledger.values(branch.slot()))
 
-def load(file_name):
-    file = open(file_name, 'rb')
-    contents = pickle.load(file)
-    _set_state(contents)
+def _branch_from_row(ledger, name, description, balance, profit, minutes):
+    branch = _Branch(name, description, ledger)
+    branch._add(balance, profit, minutes)
+    return branch
 
-def reset():
+_snapshot_magic = b'EBAYSNAP'
+_snapshot_header = struct.Struct('<8sq')
+
+_shop_magic = b'EBAYSHOP'
+_shop_version = 2
+_shop_header = struct.Struct('<8sIIqq')
+_shop_count = struct.Struct('<q')
+_block_kind = struct.Struct('<c7x')
+_block_counts = struct.Struct('<qqqq')
+_log_columns = ['_ops', '_branches', '_labels', '_texts', '_units', '_amounts', '_times']
+
+class _ErrCorrupt(ValueError):
+    pass
+
+def _aligned(data):
+    return data + bytes(-len(data) % 8)
+
+def _pack_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    ends = array('I', accumulate(map(len, encoded)))
+    return _aligned(b''.join([_shop_count.pack(len(encoded)), _aligned(ends.tobytes()),
+                              *encoded]))
+
+class _Strings:
+
+    def __init__(self, view, offset):
+        count, = _shop_count.unpack_from(view, offset)
+        self._ends, offset = _column(view, offset + _shop_count.size, 'I', count)
+        size = self._ends[-1] if count else 0
+        self._data = view[offset:offset + size]
+        self.end = offset + size + (-size % 8)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, index):
+        start = self._ends[index - 1] if index else 0
+        return str(self._data[start:self._ends[index]], 'utf-8')
+
+    def decode_all(self):
+        text = str(self._data, 'utf-8')
+        if len(text) != len(self._data):
+            return list(map(self.__getitem__, range(len(self))))
+        ends = self._ends.tolist()
+        return [text[start:end] for start, end in zip([0, *ends], ends)]
+
+def _column(view, offset, typecode, length):
+    size = array(typecode).itemsize * length
+    return view[offset:offset + size].cast(typecode), offset + size + (-size % 8)
+
+def _inventory_lots(inventory):
+    return {label: list(queue) for label, queue in inventory._lots.items()}
+
+def _inventory_data(inventory, compress=False):
+    return _pack_inventory(inventory.items(), _inventory_lots(inventory), inventory._realized,
+                           compress)
+
+def _pack_inventory(items, lots, realized, compress=False):
+    labels = []
+    units = array('q')
+    for label, held in items:
+        labels.append(label)
+        units.append(int(held))
+    indexes = {label: index for index, label in enumerate(labels)}
+    def index_of(label):
+        index = indexes.get(label)
+        if index is None:
+            index = indexes[label] = len(labels)
+            labels.append(label)
+        return index
+    lot_labels = array('I', map(index_of, lots))
+    lot_counts = array('I', map(len, lots.values()))
+    lot_values = array('q', chain.from_iterable(chain.from_iterable(lots.values())))
+    realized_labels = array('I', map(index_of, realized))
+    realized_values = array('q', realized.values())
+    columns = [units, lot_labels, lot_counts, lot_values, realized_labels, realized_values]
+    body = b''.join([_block_counts.pack(len(units), len(lot_labels), len(lot_values),
+                                        len(realized_labels)),
+                     _pack_strings(labels),
+                     *(_aligned(column.tobytes()) for column in columns)])
+    if compress:
+        return _aligned(_block_kind.pack(b'Z') + zlib.compress(body))
+    else:
+        return _block_kind.pack(b'I') + body
+
+def _unpack_inventory(view):
+    kind, = _block_kind.unpack_from(view)
+    view = view[_block_kind.size:]
+    if kind == b'Z':
+        view = memoryview(zlib.decompress(view))
+    items, lot_count, value_count, realized_count = _block_counts.unpack_from(view)
+    strings = _Strings(view, _block_counts.size)
+    units, offset = _column(view, strings.end, 'q', items)
+    lot_labels, offset = _column(view, offset, 'I', lot_count)
+    lot_counts, offset = _column(view, offset, 'I', lot_count)
+    lot_values, offset = _column(view, offset, 'q', value_count)
+    realized_labels, offset = _column(view, offset, 'I', realized_count)
+    realized_values, _ = _column(view, offset, 'q', realized_count)
+    labels = strings.decode_all()
+    inventory = _Inventory()
+    inventory._dict = _SortedDict.from_sorted_lists(labels[:items],
+                                                    list(map(_Units._raw, units.tolist())))
+    lot_values = lot_values.tolist()
+    pairs = list(zip(lot_values[::2], lot_values[1::2]))
+    costs = [0, *accumulate(lot_values[1::2])]
+    lots = inventory._lots
+    start = 0
+    for label, count in zip(lot_labels.tolist(), lot_counts.tolist()):
+        stop = start + count
+        lots[labels[label]] = _Lots.from_pairs(pairs[start:stop], costs[stop] - costs[start])
+        start = stop
+    inventory._realized = dict(zip(map(labels.__getitem__, realized_labels.tolist()),
+                                   realized_values.tolist()))
+    return inventory
+
+def _inventory_from_data(data):
+    view = memoryview(data)
+    if bytes(view[:1]) in (b'I', b'Z'):
+        return _unpack_inventory(view)
+    labels, units, *costs = pickle.loads(view)
+    inventory = _Inventory._from_sorted(zip(labels, map(_Units._raw, units)))
+    if costs:
+        lots, realized = costs
+        inventory._lots = {label: _Lots(queue) for label, queue in lots.items()}
+        inventory._realized = realized
+    return inventory
+
+def _checked(data, checksum, file_name):
+    if checksum is not None and zlib.crc32(data) != checksum:
+        raise _ErrCorrupt(file_name)
+    return data
+
+def _read_data(file_name, offset, length, checksum=None):
+    with open(file_name, 'rb') as file:
+        return _read_file_data(file, offset, length, checksum)
+
+def _read_file_data(file, offset, length, checksum=None):
+    file.seek(offset)
+    data = file.read(length)
+    if len(data) < length:
+        raise EOFError(file.name)
+    return _checked(data, checksum, file.name)
+
+def _read_inventory(file_name, offset, length, checksum=None):
+    return _inventory_from_data(_read_data(file_name, offset, length, checksum))
+
+def _snapshot_data(branch, compress=False):
+    if branch._source is not None:
+        return _read_data(*branch._source)
+    else:
+        return _inventory_data(branch.inventory(), compress)
+
+def _pack_branch_table(directory):
+    rows = array('q', chain.from_iterable(entry[2:] for entry in directory))
+    strings = chain.from_iterable(entry[:2] for entry in directory)
+    return b''.join([_shop_count.pack(len(directory)), rows.tobytes(), _pack_strings(strings)])
+
+def _unpack_branch_table(view, offset, width=6):
+    # Version 1 tables have no block checksums, so their rows are 5 wide.
+    count, = _shop_count.unpack_from(view, offset)
+    rows, offset = _column(view, offset + _shop_count.size, 'q', width * count)
+    strings = _Strings(view, offset)
+    missing = (None,) * (6 - width)
+    for index in range(count):
+        yield (strings[2 * index], strings[2 * index + 1],
+               *rows[width * index:width * index + width], *missing)
+
+def _pack_history(log):
+    columns = (getattr(log, name).tobytes() for name in _log_columns)
+    return b''.join([_shop_count.pack(len(log)), _pack_strings(log._strings),
+                     *map(_aligned, columns)])
+
+def _unpack_history(view, offset):
+    length, = _shop_count.unpack_from(view, offset)
+    strings = _Strings(view, offset + _shop_count.size)
+    log = _Log()
+    offset = strings.end
+    for name in _log_columns:
+        column = getattr(log, name)
+        values, offset = _column(view, offset, 'B', column.itemsize * length)
+        column.frombytes(values)
+    log._strings = strings.decode_all()
+    log._string_ids = {string: id for id, string in enumerate(log._strings)}
+    return log
+
+class _ChecksumWriter:
+
+    def __init__(self, file):
+        self._file = file
+        self.checksum = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def tell(self):
+        return self._file.tell()
+
+def _write_snapshot_file(temporary_name, branches, history):
+    directory = []
+    with open(temporary_name, 'wb') as file:
+        file.write(bytes(_shop_header.size))
+        for row, data in branches:
+            directory.append((*row, file.tell(), len(data), zlib.crc32(data)))
+            file.write(_aligned(data))
+        writer = _ChecksumWriter(file)
+        table_offset = writer.tell()
+        writer.write(_pack_branch_table(directory))
+        history_offset = writer.tell()
+        writer.write(_pack_history(history))
+        file.seek(0)
+        file.write(_shop_header.pack(_shop_magic, _shop_version, writer.checksum,
+                                     table_offset, history_offset))
+        file.flush()
+        os.fsync(file.fileno())
+    return directory
+
+def _fsync_directory(file_name):
+    if os.name != 'posix':
+        return
+    directory = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+def _replace_snapshot(temporary_name, file_name, sources, directory):
+    os.replace(temporary_name, file_name)
+    _fsync_directory(file_name)
+    for (branch, source), entry in zip(sources, directory):
+        if source is not None and branch._source is source:
+            branch._source = (file_name, *entry[-3:])
+
+def _write_snapshot(file_name, compress=False):
+    temporary_name = f'{file_name}.tmp'
+    branches = list(_branches.values())
+    directory = _write_snapshot_file(
+        temporary_name,
+        ((_branch_row(branch), _snapshot_data(branch, compress)) for branch in branches),
+        _history)
+    _replace_snapshot(temporary_name, file_name,
+                      [(branch, branch._source) for branch in branches], directory)
+
+def _read_shop(file_name, lazy):
+    with open(file_name, 'rb') as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _decode_shop(memoryview(mapping), file_name, lazy)
+    finally:
+        # Everything decoded is copied out of the mapping, so it can be closed
+        # now rather than whenever it is collected; a mapping left open stops
+        # a later save from replacing the file on Windows. If decoding failed,
+        # the traceback may still hold a view and the close waits for that.
+        try:
+            mapping.close()
+        except BufferError:
+            pass
+
+def _decode_shop(view, file_name, lazy):
+    _, version, checksum, table_offset, history_offset = _shop_header.unpack_from(view)
+    if version not in (1, _shop_version):
+        raise _ErrCorrupt(version)
+    # Only the table and history are checked here; each inventory block has
+    # its own checksum in the table and is checked when it is read.
+    if version == 1:
+        checked, width = _shop_header.size, 5
+    else:
+        checked, width = table_offset, 6
+    if zlib.crc32(view[checked:]) != checksum:
+        raise _ErrCorrupt(file_name)
+    ledger = _Ledger()
+    branches = []
+    for *row, offset, length, block_checksum in _unpack_branch_table(view, table_offset, width):
+        branch = _branch_from_row(ledger, *row)
+        if lazy:
+            branch._unload((file_name, offset, length, block_checksum))
+        else:
+            data = _checked(view[offset:offset + length], block_checksum, file_name)
+            branch._inventory = _inventory_from_data(data)
+        branches.append((branch.name(), branch))
+    return _SortedDict.from_sorted(branches), _unpack_history(view, history_offset)
+
+def _read_state(file_name, lazy=False):
+    with open(file_name, 'rb') as file:
+        header = file.read(_snapshot_header.size)
+    if header.startswith(_shop_magic):
+        return _read_shop(file_name, lazy)
+    with open(file_name, 'rb') as file:
+        header = file.read(_snapshot_header.size)
+        if not header.startswith(_snapshot_magic):
+            file.seek(0)
+            return pickle.load(file)
+        _, directory_offset = _snapshot_header.unpack(header)
+        file.seek(directory_offset)
+        directory, history = pickle.load(file)
+        ledger = _Ledger()
+        branches = []
+        for *row, offset, length in directory:
+            branch = _branch_from_row(ledger, *row)
+            if lazy:
+                branch._unload((file_name, offset, length))
+            else:
+                file.seek(offset)
+                branch._inventory = _inventory_from_data(file.read(length))
+            branches.append((branch.name(), branch))
+    return _SortedDict.from_sorted(branches), history
+
+_journal = None
+_journal_name = None
+_journal_entries = 0
+_journal_strings = 0
+_journal_base = 0
+_journal_limit = 10000
+_journal_header = struct.Struct('<qq')
+
+def _journal_file_name(file_name):
+    return f'{file_name}.journal'
+
+def _close_journal():
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+def _compact():
+    global _journal
+    global _journal_entries
+    global _journal_strings
+    global _journal_base
+    _close_journal()
+    _write_snapshot(_journal_name)
+    _journal = open(_journal_file_name(_journal_name), 'wb')
+    _journal.write(_journal_header.pack(len(_history), _history.num_strings()))
+    _journal.flush()
+    _journal_entries = 0
+    _journal_strings = _history.num_strings()
+    _journal_base = len(_history)
+
+def _journal_truncate(length):
+    global _journal_entries
+    if length < _journal_base:
+        _compact()
+        return
+    _journal.write(_Log._record_struct.pack(_OP_TRUNCATE, 0, 0, 0, 0, length, 0))
+    _journal.flush()
+    _journal_entries += 1
+
+@_writes
+def journal(file_name):
+    global _journal_name
+    _check_type(file_name, str)
+    _close_journal()
+    _journal_name = file_name
+    _compact()
+
+def _journal_records(file):
+    record_struct = _Log._record_struct
+    while True:
+        data = file.read(record_struct.size)
+        if len(data) < record_struct.size:
+            return
+        record = record_struct.unpack(data)
+        if record[0] == _OP_STRING:
+            data = file.read(record[4])
+            if len(data) < record[4]:
+                return
+            yield record, data.decode('utf-8')
+        else:
+            yield record, None
+
+def _extend_from_journal(log, file_name):
+    with open(_journal_file_name(file_name), 'rb') as file:
+        header = file.read(_journal_header.size)
+        if len(header) < _journal_header.size:
+            return
+        index, string_id = _journal_header.unpack(header)
+        for record, string in _journal_records(file):
+            if string is not None:
+                if string_id == log.num_strings():
+                    log.add_string(string)
+                string_id += 1
+            elif record[0] == _OP_TRUNCATE:
+                index = record[5]
+                if index < len(log):
+                    log.truncate(index)
+            else:
+                if index >= len(log):
+                    log.append_ids(*record)
+                index += 1
+
+_database = None
+_database_name = None
+_database_strings = 0
+_database_synced = True
+
+_database_schema = '''
+CREATE TABLE IF NOT EXISTS branches (
+    name        TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    balance     INTEGER NOT NULL,
+    profit      INTEGER NOT NULL,
+    minutes     INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS inventory (
+    branch      TEXT NOT NULL,
+    label       TEXT NOT NULL,
+    units       INTEGER NOT NULL,
+    PRIMARY KEY (branch, label)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS inventory_label ON inventory (label, branch);
+CREATE TABLE IF NOT EXISTS costs (
+    branch      TEXT NOT NULL,
+    label       TEXT NOT NULL,
+    lots        BLOB,
+    realized    INTEGER NOT NULL,
+    PRIMARY KEY (branch, label)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS strings (
+    id          INTEGER PRIMARY KEY,
+    string      TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS operations (
+    id          INTEGER PRIMARY KEY,
+    op          INTEGER NOT NULL,
+    branch      INTEGER NOT NULL,
+    label       INTEGER NOT NULL,
+    text        INTEGER NOT NULL,
+    units       INTEGER NOT NULL,
+    amount      INTEGER NOT NULL,
+    time        INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS operations_branch ON operations (branch, id);
+'''
+
+def _is_database(file_name):
+    with open(file_name, 'rb') as file:
+        return file.read(16) == b'SQLite format 3\x00'
+
+def _close_database():
+    global _database
+    if _database is not None:
+        _database.close()
+        _database = None
+
+def _connect(file_name):
+    connection = sqlite3.connect(file_name, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.executescript(_database_schema)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(operations)')]
+    if 'time' not in columns:
+        connection.execute('ALTER TABLE operations ADD COLUMN time INTEGER NOT NULL DEFAULT 0')
+    return connection
+
+def _use_database(connection, file_name):
+    global _database
+    global _database_name
+    global _database_synced
+    _close_database()
+    _database = connection
+    _database_name = file_name
+    _database_synced = True
+
+def _open_database(file_name):
+    _use_database(_connect(file_name), file_name)
+
+def _inventory_rows(branch):
+    name = branch.name()
+    return ((name, label, int(units)) for label, units in branch.inventory().items())
+
+def _cost_row(name, inventory, label):
+    queue = inventory._lots.get(label)
+    lots = None
+    if queue is not None:
+        lots = array('q', chain.from_iterable(queue)).tobytes()
+    return name, label, lots, inventory._realized.get(label, 0)
+
+def _cost_rows(branch):
+    inventory = branch.inventory()
+    name = branch.name()
+    for label in inventory._lots.keys() | inventory._realized.keys():
+        yield _cost_row(name, inventory, label)
+
+def _store_operations(start, stop, strings_from):
+    _database.executemany('INSERT INTO strings VALUES (?, ?)',
+                          ((id, _history.string(id))
+                           for id in range(strings_from, _history.num_strings())))
+    _database.executemany('INSERT INTO operations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          ((index, *_history.record_at(index), _history.time_at(index))
+                           for index in range(start, stop)))
+
+def _store_branch(name):
+    _database.execute('DELETE FROM inventory WHERE branch = ?', (name,))
+    _database.execute('DELETE FROM costs WHERE branch = ?', (name,))
+    _database.execute('DELETE FROM branches WHERE name = ?', (name,))
+    branch = _branches.get(name)
+    if branch is not None:
+        _database.execute('INSERT INTO branches VALUES (?, ?, ?, ?, ?)', _branch_row(branch))
+        _database.executemany('INSERT INTO inventory VALUES (?, ?, ?)', _inventory_rows(branch))
+        _database.executemany('INSERT INTO costs VALUES (?, ?, ?, ?)', _cost_rows(branch))
+
+def _touched(log, start, stop):
+    rewritten = set()
+    updated = set()
+    rows = set()
+    strings = log._strings
+    for index in range(start, stop):
+        op, branch, label, text, units, amount = log.record_at(index)
+        if op == _OP_TEXT:
+            continue
+        elif op <= _OP_SHOP_CLOCK:
+            if len(updated) < len(_branches):
+                updated.update(_branches.keys())
+            continue
+        name = strings[branch]
+        if op == _OP_RENAME or op == _OP_MERGE:
+            rewritten.update([name, strings[text]])
+        elif op == _OP_SPLIT:
+            rewritten.add(name)
+            rewritten.update(_split_names(name, amount))
+        elif op < _OP_RELABEL:
+            updated.add(name)
+        else:
+            rows.add((name, strings[label]))
+            if op == _OP_RELABEL:
+                rows.add((name, strings[text]))
+            elif op >= _OP_BUY:
+                updated.add(name)
+    rows = [(name, label) for name, label in rows if name not in rewritten]
+    return rewritten, updated - rewritten, rows
+
+def _store(start):
+    stop = len(_history)
+    _store_changes(_touched(_history, start, stop), start, stop)
+
+def _store_changes(touched, start, stop):
+    # The shop in memory is the one that counts. If a write fails, the
+    # error is raised after the command has taken effect, and the next
+    # write rewrites the whole file so it catches up.
+    global _database_strings
+    global _database_synced
+    if not _database_synced:
+        _store_all()
+        return
+    _database_synced = False
+    rewritten, updated, rows = touched
+    for name in rewritten:
+        if name in _branches:
+            _branches[name].inventory()
+    held = [(name, label, _branches[name].inventory()._dict.get(label))
+            for name, label in rows]
+    costs = [_cost_row(name, _branches[name].inventory(), label) for name, label in rows]
+    with _database:
+        _database.execute('DELETE FROM operations WHERE id >= ?', (start,))
+        _store_operations(start, stop, _database_strings)
+        for name in rewritten:
+            _store_branch(name)
+        _database.executemany('UPDATE branches SET description = ?, balance = ?, profit = ?, '
+                              'minutes = ? WHERE name = ?',
+                              ((*_branch_row(_branches[name])[1:], name) for name in updated))
+        _database.executemany('INSERT OR REPLACE INTO inventory VALUES (?, ?, ?)',
+                              ((name, label, int(units))
+                               for name, label, units in held if units is not None))
+        _database.executemany('DELETE FROM inventory WHERE branch = ? AND label = ?',
+                              ((name, label) for name, label, units in held if units is None))
+        _database.executemany('INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?)',
+                              (row for row in costs if row[2] is not None or row[3] != 0))
+        _database.executemany('DELETE FROM costs WHERE branch = ? AND label = ?',
+                              (row[:2] for row in costs if row[2] is None and row[3] == 0))
+    _database_strings = _history.num_strings()
+    _database_synced = True
+
+def _store_all():
+    global _database_strings
+    global _database_synced
+    _database_synced = False
+    with _database:
+        for table in ['branches', 'inventory', 'costs', 'strings', 'operations']:
+            _database.execute(f'DELETE FROM {table}')
+        _database.executemany('INSERT INTO branches VALUES (?, ?, ?, ?, ?)',
+                              map(_branch_row, _branches.values()))
+        for branch in _branches.values():
+            _database.executemany('INSERT INTO inventory VALUES (?, ?, ?)', _inventory_rows(branch))
+            _database.executemany('INSERT INTO costs VALUES (?, ?, ?, ?)', _cost_rows(branch))
+        _store_operations(0, len(_history), 0)
+    _database_strings = _history.num_strings()
+    _database_synced = True
+
+@_writes
+def database(file_name):
+    _check_type(file_name, str)
+    _load_inventories()
+    _open_database(file_name)
+    _store_all()
+
+def _database_branches(connection):
+    ledger = _Ledger()
+    branches = []
+    query = 'SELECT name, description, balance, profit, minutes FROM branches ORDER BY name'
+    for row in connection.execute(query):
+        branch = _branch_from_row(ledger, *row)
+        branch._unload_stored((connection, branch.name()))
+        branches.append((branch.name(), branch))
+    return _SortedDict.from_sorted(branches)
+
+def _database_inventory(connection, name):
+    query = 'SELECT label, units FROM inventory WHERE branch = ? ORDER BY label'
+    inventory = _Inventory._from_sorted(
+        (label, _Units._raw(units)) for label, units in connection.execute(query, (name,)))
+    query = 'SELECT label, lots, realized FROM costs WHERE branch = ?'
+    for label, lots, realized in connection.execute(query, (name,)):
+        if lots is not None:
+            values = array('q')
+            values.frombytes(lots)
+            inventory._lots[label] = _Lots(zip(values[::2], values[1::2]))
+        if realized != 0:
+            inventory._realized[label] = realized
+    return inventory
+
+def _database_history(connection):
+    log = _Log()
+    for string, in connection.execute('SELECT string FROM strings ORDER BY id'):
+        log.add_string(string)
+    query = 'SELECT op, branch, label, text, units, amount, time FROM operations ORDER BY id'
+    for record in connection.execute(query):
+        log.append_ids(*record)
+    return log
+
+def _load_database(file_name):
+    global _database_strings
+    connection = _connect(file_name)
+    try:
+        _set_state((_database_branches(connection), _database_history(connection)))
+    except BaseException:
+        connection.close()
+        raise
+    _use_database(connection, file_name)
+    _database_strings = _history.num_strings()
+
+@_writes
+def save(file_name, compress=False):
+    _check_type(compress, bool)
+    _write_snapshot(file_name, compress)
+
+@_writes
+def load(file_name, lazy=False):
+    _close_journal()
+    if _is_database(file_name):
+        _load_database(file_name)
+    else:
+        _set_state(_read_state(file_name, lazy))
+        _close_database()
+        if os.path.exists(_journal_file_name(file_name)):
+            start = len(_history)
+            _extend_from_journal(_history, file_name)
+            _history.check()
+            _apply(_history, start, len(_history))
+            journal(file_name)
+    if _server is not None:
+        _publish()
+    _mark_dirty()
+
+def _initial_state():
+    ledger = _Ledger()
+    branches = _SortedDict()
+    branches['Initial'] = _Branch('Initial', 'no description', ledger)
+    return ledger, branches
+
+def _clear_state():
+    global _ledger
     global _branches
     global _history
-    _branches = _SortedDict()
-    _branches['Initial'] = _Branch('Initial', 'no description')
-    _history = []
+    _ledger, _branches = _initial_state()
+    _history = _Log()
+
+@_writes
+def reset():
+    _clear_state()
+    if _journal is not None:
+        _compact()
+    if _database is not None:
+        _store_all()
+    if _server is not None:
+        _publish()
+    _mark_dirty()
+
+def _branch_contents(branch):
+    return (branch.name(),
+            branch.description(),
+            int(branch.balance()),
+            int(branch.profit()),
+            int(branch.time_spent()),
+            [(label, int(units), int(branch.inventory().cost(label)))
+             for label, units in branch.inventory().items()],
+            sorted(branch.inventory()._realized.items()))
+
+def _check_same_branches(branches):
+    for expected, actual in zip_longest(branches.values(), _branches.values()):
+        if expected is None or actual is None:
+            raise _ErrInconsistent(expected or actual)
+        if _branch_contents(expected) != _branch_contents(actual):
+            raise _ErrInconsistent(actual.name())
+
+@_writes
+def replay(source):
+    global _history
+    expected = None
+    if type(source) is str:
+        expected, log = _read_state(source)
+        if type(log) is list:
+            log = _Log.from_entries(log)
+        _check_branches(expected)
+        checked = len(log)
+        resume = os.path.exists(_journal_file_name(source))
+        if resume:
+            _extend_from_journal(log, source)
+    else:
+        log = source
+        checked = 0
+        resume = False
+    _check_history(log)
+    log.check_replayable()
+    _close_journal()
+    stored = _database is not None
+    if stored:
+        _load_inventories()
+    _close_database()
+    previous = _get_state()
+    _clear_state()
+    try:
+        _apply_checkpointed(log, 0, checked)
+        if expected is not None:
+            _check_same_branches(expected)
+        _apply_checkpointed(log, checked, len(log))
+    except BaseException:
+        _set_state(previous)
+        raise
+    else:
+        _history = log
+    finally:
+        if stored:
+            database(_database_name)
+    if resume:
+        journal(source)
+    if _server is not None:
+        _publish()
+    _mark_dirty()
+
+_checkpoint_interval = 1000
+_checkpoint_limit = 64
+_checkpoint_budget = 4000000
+_checkpoint_spacing = _checkpoint_interval
+_checkpoint_last = 0
+_checkpoints = {}
+_checkpoint_indexes = []
+_checkpoint_sizes = {}
+_checkpoints_total = 0
+_checkpoints_log = None
+
+def _drop_checkpoints(start=0):
+    global _checkpoint_last
+    global _checkpoints_total
+    _checkpoint_last = min(_checkpoint_last, start)
+    position = bisect_left(_checkpoint_indexes, start)
+    for index in _checkpoint_indexes[position:]:
+        del _checkpoints[index]
+        _checkpoints_total -= _checkpoint_sizes.pop(index)
+    del _checkpoint_indexes[position:]
+
+def _checkpoints_for(log):
+    global _checkpoints_log
+    global _checkpoint_spacing
+    if _checkpoints_log is not log:
+        _drop_checkpoints()
+        _checkpoints_log = log
+        _checkpoint_spacing = _checkpoint_interval
+
+def _checkpoint():
+    return [(_branch_row(branch), branch.inventory().frozen()) for branch in _branches.values()]
+
+def _size_checkpoint(position):
+    # Counts the labels a checkpoint doesn't share with the one before it
+    # and keeps the running total of all of them up to date.
+    global _checkpoints_total
+    index = _checkpoint_indexes[position]
+    shared = set()
+    if position > 0:
+        shared = {id(frozen) for _, frozen in _checkpoints[_checkpoint_indexes[position - 1]]}
+    size = sum(len(frozen[0]) for _, frozen in _checkpoints[index] if id(frozen) not in shared)
+    _checkpoints_total += size - _checkpoint_sizes.get(index, 0)
+    _checkpoint_sizes[index] = size
+
+def _thin_checkpoints():
+    global _checkpoint_spacing
+    global _checkpoints_total
+    _checkpoint_spacing *= 2
+    for index in _checkpoint_indexes[-2::-2]:
+        del _checkpoints[index]
+    del _checkpoint_indexes[-2::-2]
+    _checkpoint_sizes.clear()
+    _checkpoints_total = 0
+    for position in range(len(_checkpoint_indexes)):
+        _size_checkpoint(position)
+
+def _checkpoint_due(index):
+    position = bisect_left(_checkpoint_indexes, index)
+    if position < len(_checkpoint_indexes) and _checkpoint_indexes[position] == index:
+        return False
+    last = _checkpoint_indexes[position - 1] if position > 0 else 0
+    return index - last >= _checkpoint_spacing
+
+def _add_checkpoint(index):
+    global _checkpoint_last
+    _checkpoint_last = max(_checkpoint_last, index)
+    _load_inventories()
+    _checkpoints[index] = _checkpoint()
+    position = bisect_left(_checkpoint_indexes, index)
+    _checkpoint_indexes.insert(position, index)
+    _size_checkpoint(position)
+    if position + 1 < len(_checkpoint_indexes):
+        _size_checkpoint(position + 1)
+    while len(_checkpoint_indexes) > 1 and (len(_checkpoint_indexes) > _checkpoint_limit
+                                            or _checkpoints_total > _checkpoint_budget):
+        _thin_checkpoints()
+
+def _checkpoint_recorded():
+    _checkpoints_for(_history)
+    if len(_history) - _checkpoint_last >= _checkpoint_spacing:
+        _add_checkpoint(len(_history))
+
+def _apply_checkpointed(log, start, stop):
+    _checkpoints_for(log)
+    while start < stop:
+        step = min(stop, start + _checkpoint_spacing)
+        _apply(log, start, step)
+        start = step
+        if _checkpoint_due(start):
+            _add_checkpoint(start)
+
+def _restore_checkpoint(checkpoint):
+    ledger = _Ledger()
+    branches = []
+    for row, frozen in checkpoint:
+        branch = _branch_from_row(ledger, *row)
+        branch._inventory = _Inventory._from_frozen(frozen)
+        branch._inventory._attach(branch)
+        branches.append((branch.name(), branch))
+    return ledger, _SortedDict.from_sorted(branches)
+
+def _nearest_checkpoint(op_index):
+    _checkpoints_for(_history)
+    position = bisect_right(_checkpoint_indexes, op_index) - 1
+    if position < 0:
+        return 0, _initial_state()
+    start = _checkpoint_indexes[position]
+    return start, _restore_checkpoint(_checkpoints[start])
+
+@_writes
+def _state_at(op_index):
+    global _ledger
+    global _branches
+    start, state = _nearest_checkpoint(op_index)
+    previous = _ledger, _branches
+    _ledger, _branches = state
+    try:
+        _apply_checkpointed(_history, start, op_index)
+        return _ledger, _branches
+    finally:
+        _ledger, _branches = previous
+
+class _BranchView:
+
+    def __init__(self, op_index, branch):
+        _check_type(branch, _Branch)
+        self._op_index = op_index
+        self._branch = branch
+
+    def __str__(self):
+        return f'as_of({self._op_index}).branch({self._branch.name()!r})'
+
+    name = _BranchInterface.name
+    description = _BranchInterface.description
+    summary = _BranchInterface.summary
+    inventory = _BranchInterface.inventory
+
+class _ShopView:
+
+    def __init__(self, op_index, ledger, branches):
+        self._op_index = op_index
+        self._ledger = ledger
+        self._branches = branches
+
+    def __str__(self):
+        return f'as_of({self._op_index})'
+
+    def _call(self, function, *args):
+        global _ledger
+        global _branches
+        with _state_lock:
+            previous = _ledger, _branches
+            _ledger, _branches = self._ledger, self._branches
+            try:
+                return function(*args)
+            finally:
+                _ledger, _branches = previous
+
+    def summary(self):
+        self._call(summary)
+
+    def branch_names(self):
+        self._call(branch_names)
+
+    def branch_summaries(self, sort_by=None, page=None, offset=0, limit=None, file=None):
+        self._call(branch_summaries, sort_by, page, offset, limit, file)
+
+    def branch(self, num_or_name):
+        return _BranchView(self._op_index, self._call(branch, num_or_name)._branch)
+
+def as_of(op_index):
+    _check_type(op_index, int)
+    _check_minimum(op_index, 0)
+    if op_index > len(_history):
+        raise ValueError(op_index)
+    _history.check_replayable()
+    return _ShopView(op_index, *_state_at(op_index))
+
+_undo_limit = 10000
+_undo_data = deque(maxlen=_undo_limit)
+_undo_log = None
+_redo = []
+_remembered_ops = {_OP_SHOP_DEPOSIT, _OP_SHOP_WITHDRAW, _OP_SHOP_EARN,
+                   _OP_SHOP_SPEND, _OP_SHOP_CLOCK, _OP_DESCRIBE, _OP_MERGE,
+                   _OP_DISCARD, _OP_SELL}
+
+def _check_undo_log():
+    global _undo_log
+    if _undo_log is not _history:
+        _undo_data.clear()
+        _redo.clear()
+        _undo_log = _history
+
+def _remember(index, data):
+    _check_undo_log()
+    _undo_data.append((index, data))
+
+def _shop_inverter(deposited, earned, spent):
+    def undo(strings, branch, label, text, units, amount, shares):
+        for branch, share in zip(list(_branches.values()), shares):
+            branch._add(-deposited * share, -earned * share, -spent * share)
+    return undo
+
+def _branch_inverter(deposited, earned, spent):
+    def undo(strings, branch, label, text, units, amount, data):
+        _branches[strings[branch]]._add(-deposited * amount, -earned * amount, -spent * amount)
+    return undo
+
+def _undo_rename(strings, branch, label, text, units, amount, data):
+    _rename_branch(_branches[strings[text]], strings[branch])
+
+def _undo_describe(strings, branch, label, text, units, amount, description):
+    _branches[strings[branch]]._description = description
+
+def _undo_split(strings, branch, label, text, units, amount, data):
+    first, *others = [_branches[name] for name in _split_names(strings[branch], amount)]
+    _merge_branches(first, others)
+    _rename_branch(first, strings[branch])
+
+def _undo_merge(strings, branch, label, text, units, amount, contents):
+    row, data = contents
+    target = _branches[strings[branch]]
+    inventory = _inventory_from_data(data)
+    target.inventory()._unmerge(inventory)
+    target._add(*(-value for value in row[2:]))
+    other = _branch_from_row(_ledger, *row)
+    other._inventory = inventory
+    inventory._attach(other)
+    _branches[other.name()] = other
+
+def _undo_relabel(strings, branch, label, text, units, amount, data):
+    _branches[strings[branch]].inventory()._unrelabel(strings[label], strings[text], units)
+
+def _undo_acquire(strings, branch, label, text, units, amount, data):
+    _branches[strings[branch]].inventory()._remove(strings[label], units, from_end=True)
+
+def _undo_discard(strings, branch, label, text, units, amount, taken):
+    _branches[strings[branch]].inventory()._restore(strings[label], units, taken)
+
+def _undo_buy(strings, branch, label, text, units, amount, data):
+    branch = _branches[strings[branch]]
+    branch.inventory()._remove(strings[label], units, from_end=True)
+    branch._add(amount, amount, 0)
+
+def _undo_sell(strings, branch, label, text, units, amount, taken):
+    branch = _branches[strings[branch]]
+    branch._add(-amount, -amount, 0)
+    branch.inventory()._restore(strings[label], units, taken, amount)
+
+_inverters = [None,
+              _shop_inverter(1, 0, 0),
+              _shop_inverter(-1, 0, 0),
+              _shop_inverter(1, 1, 0),
+              _shop_inverter(-1, -1, 0),
+              _shop_inverter(0, 0, 1),
+              _branch_inverter(1, 0, 0),
+              _branch_inverter(-1, 0, 0),
+              _branch_inverter(1, 1, 0),
+              _branch_inverter(-1, -1, 0),
+              _branch_inverter(0, 0, 1),
+              _undo_rename,
+              _undo_describe,
+              _undo_split,
+              _undo_merge,
+              _undo_relabel,
+              _undo_acquire,
+              _undo_discard,
+              _undo_buy,
+              _undo_sell]
+
+def _check_undoable(start, stop):
+    ops = _history._ops[start:stop]
+    if _OP_TEXT in ops:
+        raise _ErrNotUndoable(_history.entry(start + ops.index(_OP_TEXT)))
+    needed = [index for index in range(stop - 1, start - 1, -1)
+              if _history._ops[index] in _remembered_ops]
+    remembered = [index for index, _ in islice(reversed(_undo_data), len(needed))]
+    for index, found in zip_longest(needed, remembered):
+        if index != found:
+            raise _ErrNotUndoable(_history.entry(index))
+
+def _truncate_history(start):
+    stop = len(_history)
+    touched = None
+    if _database is not None or _server is not None:
+        touched = _touched(_history, start, stop)
+    _retract_views(start)
+    _history.truncate(start)
+    _drop_checkpoints(start + 1)
+    if _journal is not None:
+        _journal_truncate(start)
+    if _server is not None:
+        _publish(touched)
+    _mark_dirty()
+    if _database is not None:
+        _store_changes(touched, start, start)
+
+@_writes
+def undo(n=1):
+    _check_type(n, int)
+    _check_minimum(n, 1)
+    _check_minimum(len(_history), n)
+    _check_undo_log()
+    stop = len(_history)
+    start = stop - n
+    _check_undoable(start, stop)
+    strings = _history._strings
+    undone = []
+    for index in range(stop - 1, start - 1, -1):
+        record = _history.record_at(index)
+        data = None
+        if record[0] in _remembered_ops:
+            data = _undo_data.pop()[1]
+        _inverters[record[0]](strings, *record[1:], data)
+        undone.append((record, data))
+    _truncate_history(start)
+    _redo.extend(undone)
+
+@_writes
+def redo(n=1):
+    _check_type(n, int)
+    _check_minimum(n, 1)
+    _check_undo_log()
+    _check_minimum(len(_redo), n)
+    start = len(_history)
+    strings = _history._strings
+    for _ in range(n):
+        record, data = _redo.pop()
+        _replayers[record[0]](strings, *record[1:])
+        if record[0] in _remembered_ops:
+            _remember(len(_history), data)
+        _history.append_ids(*record)
+    _recorded(start, redone=True)
+
+_profit_signs = {_OP_SHOP_EARN: 1, _OP_SHOP_SPEND: -1,
+                 _OP_EARN: 1, _OP_SPEND: -1,
+                 _OP_BUY: -1, _OP_SELL: 1}
+
+_balance_signs = {_OP_SHOP_DEPOSIT: 1, _OP_SHOP_WITHDRAW: -1,
+                  _OP_SHOP_EARN: 1, _OP_SHOP_SPEND: -1,
+                  _OP_DEPOSIT: 1, _OP_WITHDRAW: -1,
+                  _OP_EARN: 1, _OP_SPEND: -1,
+                  _OP_BUY: -1, _OP_SELL: 1}
+
+class _Shares:
+
+    def __init__(self, balances=(('Initial', 0),), exact=True):
+        self._balances = _SortedDict.from_sorted(balances)
+        self._exact = exact
+
+    def distribute(self, op, amount):
+        if not self._exact:
+            return [('*', amount)]
+        names = list(self._balances.keys())
+        balances = list(self._balances.values())
+        shares = _largest_remainder_shares(balances, sum(balances), amount)
+        direction = _balance_signs.get(op, 0)
+        if direction != 0:
+            self._balances = _SortedDict.from_sorted(
+                (name, balance + direction * share)
+                for name, balance, share in zip(names, balances, shares))
+        return [(name, share) for name, share in zip(names, shares) if share != 0]
+
+    def apply(self, op, name, text, amount):
+        balances = self._balances
+        if op == _OP_TEXT:
+            self._exact = False
+        elif not self._exact:
+            return
+        elif op == _OP_RENAME:
+            balances[text] = balances[name]
+            del balances[name]
+        elif op == _OP_SPLIT:
+            balance = balances[name]
+            del balances[name]
+            for child, part in zip(_split_names(name, amount), _split_int(balance, amount)):
+                balances[child] = part
+        elif op == _OP_MERGE:
+            balances[name] += balances[text]
+            del balances[text]
+        elif op in _balance_signs:
+            balances[name] += _balance_signs[op] * amount
+
+def _fact(op, name, label, amount, timestamp):
+    profit = _profit_signs.get(op, 0) * amount
+    minutes = amount if op == _OP_SHOP_CLOCK or op == _OP_CLOCK else 0
+    return op, name, label, profit, minutes, timestamp
+
+def _facts(log, start, stop, shares):
+    strings = log._strings
+    for index in range(start, stop):
+        op, branch, label, text, units, amount = log.record_at(index)
+        if op == _OP_TEXT:
+            shares.apply(op, None, None, amount)
+        elif op <= _OP_SHOP_CLOCK:
+            timestamp = log.time_at(index)
+            for name, share in shares.distribute(op, amount):
+                yield _fact(op, name, None, share, timestamp)
+        else:
+            name = strings[branch]
+            shares.apply(op, name, strings[text] if text >= 0 else None, amount)
+            yield _fact(op, name, strings[label] if label >= 0 else None, amount,
+                        log.time_at(index))
+
+@functools.lru_cache(maxsize=1024)
+def _quarter_hour_week(quarter_hour):
+    day = date.fromtimestamp(quarter_hour * 900)
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+def _week(timestamp):
+    if timestamp == 0:
+        return 'unknown'
+    return _quarter_hour_week(timestamp // 900)
+
+class _View:
+
+    def __init__(self, columns, value_name, value_type, key, value):
+        self._columns = columns
+        self._value_name = value_name
+        self._value_type = value_type
+        self._key = key
+        self._value = value
+        self._totals = {}
+
+    def add(self, fact, sign):
+        key = self._key(*fact)
+        if key is None:
+            return
+        totals = self._totals
+        total, count = totals.get(key, (0, 0))
+        count += sign
+        if count == 0:
+            del totals[key]
+        else:
+            totals[key] = (total + sign * self._value(*fact), count)
+
+    def rows(self):
+        _sync_views()
+        for key, (total, _) in sorted(self._totals.items()):
+            yield [*key, self._value_type._raw(total)]
+
+    def __len__(self):
+        _sync_views()
+        return len(self._totals)
+
+_views = {}
+_views_log = None
+_views_applied = 0
+_views_shares = None
+
+def _register_view(name, columns, value_name, value_type, key, value):
+    global _views_log
+    _views[name] = _View(columns, value_name, value_type, key, value)
+    _views_log = None
+
+def _add_facts(start, stop, sign, shares):
+    views = list(_views.values())
+    for fact in _facts(_history, start, stop, shares):
+        for view in views:
+            view.add(fact, sign)
+
+def _sync_views():
+    global _views_log
+    global _views_applied
+    global _views_shares
+    if _views_log is not _history:
+        for view in _views.values():
+            view._totals = {}
+        _views_log = _history
+        _views_applied = 0
+        _views_shares = _Shares()
+    if _views_applied < len(_history):
+        _add_facts(_views_applied, len(_history), 1, _views_shares)
+        _views_applied = len(_history)
+
+def _retract_views(start):
+    global _views_applied
+    global _views_shares
+    if _views_log is not _history or _views_applied <= start:
+        return
+    balances = [(name, int(branch.balance())) for name, branch in _branches.items()]
+    _add_facts(start, _views_applied, -1, _Shares(balances, _views_shares._exact))
+    _views_applied = start
+    _views_shares = _Shares(balances, _views_shares._exact)
+
+def _label_key(op, branch, label, profit, minutes, timestamp):
+    if op == _OP_BUY or op == _OP_SELL:
+        return (label,)
+
+def _weekly_key(op, branch, label, profit, minutes, timestamp):
+    if op in _profit_signs:
+        return (branch, _week(timestamp))
+
+def _hours_key(op, branch, label, profit, minutes, timestamp):
+    if op == _OP_SHOP_CLOCK or op == _OP_CLOCK:
+        return (branch,)
+
+def _fact_profit(op, branch, label, profit, minutes, timestamp):
+    return profit
+
+def _fact_minutes(op, branch, label, profit, minutes, timestamp):
+    return minutes
+
+_register_view('label profit', ['Label'], 'Profit', _Cents, _label_key, _fact_profit)
+_register_view('weekly profit', ['Branch', 'Week'], 'Profit', _Cents, _weekly_key, _fact_profit)
+_register_view('branch hours', ['Branch'], 'Time Spent', _Minutes, _hours_key, _fact_minutes)
+
+def report(name=None, page=None, offset=0, limit=None, file=None):
+    if name is None:
+        print('\n'.join(_views))
+        return
+    view = _views[name]
+    start, stop = _page_range(len(view), page, offset, limit)
+    header = [[*view._columns, view._value_name]]
+    alignments = 'l' * len(view._columns) + 'r'
+    paddings = '0' + '3' * len(view._columns)
+    _write_table(chain(header, islice(view.rows(), start, stop)), alignments, paddings, file)
+
+_stats_samples = 10000
+_stats_random = random.Random()
+_stats = {}
+_stats_depth = 0
+_stats_tracing = False
+
+class _CallStats:
+
+    def __init__(self):
+        self._calls = 0
+        self._seconds = 0.0
+        self._peak = 0
+        self._samples = array('d')
+
+    def add(self, seconds, peak):
+        self._calls += 1
+        self._seconds += seconds
+        self._peak += peak
+        if len(self._samples) < _stats_samples:
+            self._samples.append(seconds)
+        else:
+            index = _stats_random.randrange(self._calls)
+            if index < _stats_samples:
+                self._samples[index] = seconds
+
+    def seconds(self):
+        return self._seconds
+
+    def row(self, name):
+        samples = sorted(self._samples)
+        def percentile(fraction):
+            return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+        return [name,
+                self._calls,
+                _milliseconds_text(self._seconds),
+                _milliseconds_text(self._seconds / self._calls),
+                _milliseconds_text(percentile(0.5)),
+                _milliseconds_text(percentile(0.9)),
+                _milliseconds_text(percentile(0.99)),
+                _milliseconds_text(samples[-1]),
+                _kibibytes_text(self._peak / self._calls)]
+
+def _milliseconds_text(seconds):
+    return f'{seconds * 1000:.3f}ms'
+
+def _kibibytes_text(size):
+    return f'{size / 1024:.1f}KiB'
+
+def _instrumented(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        global _stats_depth
+        if _stats_depth > 0:
+            return function(*args, **kwargs)
+        _stats_depth += 1
+        tracemalloc.reset_peak()
+        memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            _stats_depth -= 1
+            entry = _stats.get(name)
+            if entry is None:
+                entry = _stats[name] = _CallStats()
+            entry.add(seconds, tracemalloc.get_traced_memory()[1] - memory)
+    wrapper._instrumented = function
+    return wrapper
+
+_profiled_functions = ['branch', 'branch_names', 'branch_descriptions', 'branch_summaries',
+                       'summary', 'deposit', 'withdraw', 'earn', 'spend', 'clock',
+                       'where', 'where_prefix', 'where_between', 'count_between',
+                       'count_prefix', 'top', 'history', 'import_orders',
+                       'undo', 'redo', 'as_of', 'report',
+                       'save', 'load', 'journal', 'database', 'replay', 'reset',
+                       'serve', 'stop_serving', 'autosave', 'stop_autosave', 'flush']
+
+def _profiled_methods():
+    for cls in [_BranchInterface, _ItemInterface]:
+        for name, function in list(vars(cls).items()):
+            if not name.startswith('_') and callable(function):
+                yield cls, name, function
+
+def profile(enabled=True):
+    global _stats_tracing
+    _check_type(enabled, bool)
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _stats_tracing = True
+    elif not enabled and _stats_tracing:
+        tracemalloc.stop()
+        _stats_tracing = False
+    namespace = globals()
+    for name in _profiled_functions:
+        function = getattr(namespace[name], '_instrumented', namespace[name])
+        namespace[name] = _instrumented(name, function) if enabled else function
+    for cls, name, function in _profiled_methods():
+        function = getattr(function, '_instrumented', function)
+        wrapped = _instrumented(f'{cls.__name__}.{name}', function)
+        setattr(cls, name, wrapped if enabled else function)
+
+def stats(sort_by='total'):
+    if sort_by == 'total':
+        key = _CallStats.seconds
+    elif sort_by == 'calls':
+        key = lambda entry: entry._calls
+    else:
+        raise ValueError(sort_by)
+    data = [['Function', 'Calls', 'Total', 'Mean', 'p50', 'p90', 'p99', 'Max', 'Peak Memory']]
+    for name, entry in sorted(_stats.items(), key=lambda item: key(item[1]), reverse=True):
+        data.append(entry.row(name))
+    print(_table(data, 'lrrrrrrrr', '033333333'))
+
+def clear_stats():
+    _stats.clear()
+
+_server = None
+_snapshot = None
+_snapshot_source = None
+_snapshot_branches = None
+
+class _Snapshot:
+
+    def __init__(self, branches, totals, length):
+        self._branches = branches
+        self._totals = totals
+        self._length = length
+
+    def branch(self, name):
+        return self._branches[name]
+
+    def branch_at(self, num):
+        return self._branches.value_at(_RowNum(num).index())
+
+def _branch_snapshot(branch):
+    return _branch_row(branch), branch.inventory()._dict.freeze()
+
+def _publish(touched=None):
+    global _snapshot
+    global _snapshot_source
+    global _snapshot_branches
+    if touched is None or _snapshot_source is not _branches:
+        _snapshot_source = _branches
+        _snapshot_branches = _SortedDict.from_sorted(
+            (name, _branch_snapshot(branch)) for name, branch in _branches.items())
+    else:
+        rewritten, updated, rows = touched
+        for name in rewritten.union(updated, (name for name, _ in rows)):
+            branch = _branches.get(name)
+            if branch is not None:
+                _snapshot_branches[name] = _branch_snapshot(branch)
+            elif name in _snapshot_branches:
+                del _snapshot_branches[name]
+    totals = _ledger.totals()
+    _snapshot = _Snapshot(_snapshot_branches.freeze(),
+                          (totals._balance, totals._profit, totals._minutes),
+                          len(_history))
+
+def _write_summary(balance, profit, minutes, file):
+    profit = _Cents._raw(profit)
+    time_spent = _Minutes._raw(minutes)
+    data = [['Balance', 'Profit', 'Time Spent', 'Wage'],
+            [_Balance._raw(balance), profit, time_spent, _Wage(profit, time_spent)]]
+    _write_table(data, 'rrrr', '0333', file)
+
+def _write_snapshot_summaries(snapshot, sort_by, page, offset, limit, file):
+    rows = [row for row, _ in snapshot._branches.values()]
+    _write_summaries(list(snapshot._branches.keys()), [row[2] for row in rows],
+                     [row[3] for row in rows], [row[4] for row in rows],
+                     sort_by, page, offset, limit, file)
+
+def _query_int(query, name, default=None):
+    value = query.get(name)
+    if value is None:
+        return default
+    else:
+        return int(value)
+
+def _serve_path(snapshot, path, query, file):
+    page = _query_int(query, 'page')
+    offset = _query_int(query, 'offset', 0)
+    limit = _query_int(query, 'limit')
+    if path == ['summary']:
+        _write_summary(*snapshot._totals, file)
+    elif path == ['branch_summaries']:
+        _write_snapshot_summaries(snapshot, query.get('sort_by'), page, offset, limit, file)
+    elif len(path) == 2 and path[0] == 'branch' and 'num' in query:
+        _serve_branch(snapshot.branch_at(_query_int(query, 'num')), path[1],
+                      page, offset, limit, file)
+    elif len(path) == 3 and path[0] == 'branch':
+        _serve_branch(snapshot.branch(path[1]), path[2], page, offset, limit, file)
+    else:
+        raise KeyError('/'.join(path))
+
+def _serve_branch(branch, view, page, offset, limit, file):
+    row, inventory = branch
+    if view == 'summary':
+        _write_summary(*row[2:], file)
+    elif view == 'inventory':
+        _write_inventory(inventory, page, offset, limit, file)
+    else:
+        raise KeyError(view)
+
+def _respond(request):
+    parts = request.decode('latin-1').split()
+    if len(parts) != 3:
+        return '400 Bad Request', 'bad request\n'
+    method, target, _ = parts
+    if method != 'GET':
+        return '405 Method Not Allowed', f'{method} not allowed\n'
+    url = urlsplit(target)
+    path = [unquote(part) for part in url.path.strip('/').split('/')]
+    query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    snapshot = _snapshot
+    file = io.StringIO()
+    try:
+        _serve_path(snapshot, path, query, file)
+    except (KeyError, IndexError) as error:
+        return '404 Not Found', f'not found: {error}\n'
+    except (ValueError, TypeError) as error:
+        return '400 Bad Request', f'bad request: {error}\n'
+    return '200 OK', file.getvalue()
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while await reader.readline() not in (b'\r\n', b'\n', b''):
+            pass
+        status, body = _respond(request)
+        body = body.encode()
+        writer.write(f'HTTP/1.1 {status}\r\n'
+                     f'Content-Type: text/plain; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def _close_server(server):
+    server.close()
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def serve(port=8000, host='127.0.0.1'):
+    global _server
+    _check_type(port, int)
+    _check_type(host, str)
+    _stop_serving()
+    _load_inventories()
+    loop = asyncio.new_event_loop()
+    try:
+        server = loop.run_until_complete(asyncio.start_server(_handle, host, port))
+    except BaseException:
+        loop.close()
+        raise
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    _server = loop, server, thread
+    _publish()
+    thread.start()
+
+def _stop_serving():
+    global _server
+    global _snapshot
+    global _snapshot_source
+    global _snapshot_branches
+    if _server is None:
+        return
+    loop, server, thread = _server
+    _server = None
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(_close_server(server))
+    loop.close()
+    _snapshot = None
+    _snapshot_source = None
+    _snapshot_branches = None
+
+def stop_serving():
+    _stop_serving()
+
+_autosave_delay = 2
+_generation = 0
+_autosaver = None
+
+def _pack_frozen(frozen):
+    items, lots, realized = frozen
+    return _pack_inventory(items.items(),
+                           {label: list(queue) for label, queue in lots.items()}, realized)
+
+def _capture(history):
+    branches = []
+    files = {}
+    for branch in _branches.values():
+        source = branch._source
+        if source is not None:
+            file_name = source[0]
+            if file_name not in files:
+                files[file_name] = open(file_name, 'rb')
+            data = functools.partial(_read_file_data, files[file_name], *source[1:])
+        else:
+            data = branch.inventory().frozen()
+        branches.append((branch, source, _branch_row(branch), data))
+    return branches, _history.mirror(history), files
+
+class _Autosave:
+
+    def __init__(self, file_name, delay):
+        self._file_name = file_name
+        self._delay = delay
+        self._condition = threading.Condition()
+        self._saved = _generation - 1
+        self._wanted = 0
+        self._changed = 0
+        self._closing = False
+        self._error = None
+        self._source = None
+        self._history = None
+        self._packed = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def changed(self):
+        with self._condition:
+            self._changed = time.monotonic()
+            self._condition.notify_all()
+
+    def _wait(self):
+        with self._condition:
+            while True:
+                if self._saved == _generation:
+                    if self._closing:
+                        return False
+                    self._condition.wait()
+                    continue
+                remaining = self._changed + self._delay - time.monotonic()
+                if self._closing or self._saved < self._wanted or remaining <= 0:
+                    return True
+                self._condition.wait(remaining)
+
+    def _save(self):
+        with _state_lock:
+            generation = _generation
+            if self._source is not _history:
+                self._source, self._history = _history, None
+            branches, self._history, files = _capture(self._history)
+            history = self._history
+        packed = {}
+        def data_of(data):
+            if callable(data):
+                return data()
+            cached = self._packed.get(id(data))
+            block = cached[1] if cached is not None and cached[0] is data else _pack_frozen(data)
+            packed[id(data)] = data, block
+            return block
+        temporary_name = f'{self._file_name}.autosave'
+        try:
+            directory = _write_snapshot_file(
+                temporary_name, ((row, data_of(data)) for _, _, row, data in branches), history)
+        finally:
+            for file in files.values():
+                file.close()
+            self._packed = packed
+        with _state_lock:
+            _replace_snapshot(temporary_name, self._file_name,
+                              [(branch, source) for branch, source, _, _ in branches], directory)
+        return generation
+
+    def _run(self):
+        while self._wait():
+            generation = _generation
+            error = None
+            try:
+                generation = self._save()
+            except Exception as exception:
+                error = exception
+                print(f'autosave to {self._file_name!r} failed: {exception!r}', file=sys.stderr)
+            with self._condition:
+                self._saved = generation
+                self._error = error
+                self._condition.notify_all()
+
+    def flush(self):
+        with self._condition:
+            generation = _generation
+            self._wanted = max(self._wanted, generation)
+            self._condition.notify_all()
+            while self._saved < generation:
+                self._condition.wait()
+            error = self._error
+        if error is not None:
+            raise error
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+def _mark_dirty():
+    global _generation
+    _generation += 1
+    if _autosaver is not None:
+        _autosaver.changed()
+
+def autosave(file_name, delay=_autosave_delay):
+    global _autosaver
+    _check_type(file_name, str)
+    _check_minimum(delay, 0)
+    _stop_autosave()
+    _autosaver = _Autosave(file_name, delay)
+
+def _stop_autosave():
+    global _autosaver
+    if _autosaver is None:
+        return
+    autosaver = _autosaver
+    _autosaver = None
+    autosaver.close()
+
+def stop_autosave():
+    _stop_autosave()
+
+def flush():
+    if _autosaver is not None:
+        _autosaver.flush()
+
+atexit.register(_stop_autosave)